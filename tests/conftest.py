@@ -1,3 +1,8 @@
+import os
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+
 ##########################
 # Global testing options
 ##########################
@@ -8,6 +13,15 @@ def pytest_addoption(parser):
     parser.addoption("--refresh_cache", action="store_true", help="Refreshes the API cache for the tests, to ensure the latest data is used.")
     parser.addoption("--use_cache", action="store_true", help="Uses the API cache for the tests, to reduce the number of actual API calls.")
 
+def pytest_configure(config):
+    global refresh_cache, use_cache
+
+    # The cache options must be known before test modules are imported, since testing_utils sets up the 
+    # API cache at import time. With --use_cache, every LLM response is appended to the cache file as soon as it 
+    # arrives, so an interrupted or failed run can be resumed, and only the missing calls are actually made.
+    refresh_cache = config.getoption("refresh_cache")
+    use_cache = config.getoption("use_cache")
+
 def pytest_generate_tests(metafunc):
     global refresh_cache, use_cache
     refresh_cache = metafunc.config.getoption("refresh_cache")
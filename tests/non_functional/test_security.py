@@ -8,10 +8,6 @@ import textwrap
 import logging
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
 
 from tinytroupe import openai_utils
 
@@ -1,18 +1,15 @@
 import pytest
 import logging
+import chevron
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
-
 
 import tinytroupe
 from tinytroupe.agent import TinyPerson
 from tinytroupe.environment import TinyWorld, TinySocialNetwork
 from tinytroupe.factory import TinyPersonFactory
 from tinytroupe.extraction import ResultsExtractor
+import tinytroupe.utils as utils
 
 from tinytroupe.examples import create_lisa_the_data_scientist, create_oscar_the_architect, create_marcos_the_physician
 from tinytroupe.extraction import default_extractor as extractor
@@ -21,10 +18,10 @@ from tinytroupe.control import Simulation
 
 from testing_utils import *
 
-def test_ad_evaluation_scenario(setup):
-    # user search query: "europe travel package"
+# The ads and the evaluation request are constant, so they are built only once, at import time.
+# user search query: "europe travel package"
 
-    travel_ad_1 =\
+TRAVEL_AD_1 =\
     """
     Tailor-Made Tours Of Europe - Nat'l Geographic Award Winner
     https://www.kensingtontours.com/private-tours/europe
@@ -53,7 +50,7 @@ def test_ad_evaluation_scenario(setup):
     See more at kensingtontours.com
     """
 
-    travel_ad_2 =\
+TRAVEL_AD_2 =\
     """
     Europe all-inclusive Packages - Europe Vacation Packages
     https://www.exoticca.com/europe/tours
@@ -65,7 +62,7 @@ def test_ad_evaluation_scenario(setup):
     Types: Lodge, Resort & Spa, Guest House, Luxury Hotel, Tented Lodge
     """
 
-    travel_ad_3 =\
+TRAVEL_AD_3 =\
     """
     Travel Packages - Great Vacation Deals
     https://www.travelocity.com/travel/packages
@@ -92,7 +89,7 @@ def test_ad_evaluation_scenario(setup):
     Discover the Difference
     """
 
-    travel_ad_4 =\
+TRAVEL_AD_4 =\
     """
     Europe Luxury Private Tours
     https://www.kensingtontours.com
@@ -100,33 +97,82 @@ def test_ad_evaluation_scenario(setup):
     """
 
 
-    eval_request_msg = \
+EVAL_REQUEST_MSG = \
     f"""
     Can you please evaluate these Bing ads for me? Which one convices you more to buy their particular offering? Select **ONLY** one. Please explain your reasoning, based on your background and personality.
 
     # AD 1
     ```
-    {travel_ad_1}
+    {TRAVEL_AD_1}
     ```
 
     # AD 2
     ```
-    {travel_ad_2}
+    {TRAVEL_AD_2}
     ```
 
     # AD 3
     ```
-    {travel_ad_3}
+    {TRAVEL_AD_3}
     ```
 
     # AD 4
     ```
-    {travel_ad_4}
+    {TRAVEL_AD_4}
     ```
 
     """
 
-    print(eval_request_msg)
+def extract_results_from_agents_in_one_call(extractor, agents, extraction_objective, situation, fields):
+    """
+    Extracts one result per agent with a single LLM call, by placing all the agents' interaction histories
+    in the same request and asking for a JSON array with the results in the same order. If the model's
+    output cannot be matched to the agents, falls back to one extraction call per agent.
+    """
+    messages = []
+
+    messages.append({"role": "system", 
+                     "content": chevron.render(utils.tokenized_template(extractor._extraction_prompt_template_path), 
+                                               {"fields": ", ".join(fields)})})
+
+    agents_histories = "\n\n".join(f"--- AGENT {agent.name} ---\n{agent.pretty_current_interactions(max_content_length=None)}"
+                                    for agent in agents)
+
+    extraction_request_prompt = \
+f"""
+## Extraction objective
+
+{extraction_objective}
+
+## Situation
+You are considering {len(agents)} agents, each one independently. Your objective refers to each agent separately,
+so you must output a JSON array with exactly one result per agent, in the same order in which the agents are given below.
+{situation}
+
+## Agents Interactions Histories
+
+Each agent's history of interactions starts with a line like `--- AGENT <name> ---`, and includes stimuli 
+the agent received as well as actions it performed.
+
+{agents_histories}
+"""
+    messages.append({"role": "user", "content": extraction_request_prompt})
+
+    next_message = openai_utils.client().send_message(messages, temperature=0.0)
+    logger.debug(f"Batched extraction raw result message: {next_message}")
+
+    results = utils.extract_json(next_message["content"]) if next_message is not None else None
+
+    if isinstance(results, list) and len(results) == len(agents) and all(isinstance(result, dict) for result in results):
+        return results
+    
+    else:
+        logger.warning(f"Could not use the batched extraction result, extracting from each agent instead: {results}")
+        return [extractor.extract_results_from_agent(agent, extraction_objective=extraction_objective, situation=situation, fields=fields) 
+                for agent in agents]
+
+def test_ad_evaluation_scenario(setup):
+    print(EVAL_REQUEST_MSG)
 
     situation = "You decided you want to visit Europe and you are planning your next vacations. You start by searching for good deals as well as good ideas."
 
@@ -136,17 +182,19 @@ def test_ad_evaluation_scenario(setup):
 
     for person in people:
         person.change_context(situation)
-        person.listen_and_act(eval_request_msg)
+
+    # the agents are independent and the work is bound by the LLM calls, so they can act concurrently
+    run_concurrently(lambda person: person.listen_and_act(EVAL_REQUEST_MSG), people)
         
     extractor = ResultsExtractor()
     choices = []
 
-    for person in people:
-        res = extractor.extract_results_from_agent(person,
-                                        extraction_objective=extraction_objective,
-                                        situation=situation,
-                                        fields=["ad_id", "ad_title", "justification"])
-        
+    results = extract_results_from_agents_in_one_call(extractor, people,
+                                                      extraction_objective=extraction_objective,
+                                                      situation=situation,
+                                                      fields=["ad_id", "ad_title", "justification"])
+
+    for person, res in zip(people, results):
         print(f"Agent {person.name} choice: {res}")
 
         assert res is not None, "There should be a result."
@@ -224,14 +272,13 @@ def test_consumer_profiling_scenario(setup):
 
     consumer_factory = TinyPersonFactory(general_context)
 
-    from time import sleep
-
-
     consumers = []
+
+    # Consumers are interviewed one at a time on purpose: the factory relies on the previously generated
+    # names to keep new ones unique, and the simulation records its transactions sequentially.
     def interview_consumer_batch(n):
         for i in range(n):
             print(f"################################### Interviewing consumer {i+1} of {n} ###################################")
-            sleep(2)
             consumer = consumer_factory.generate_person("A random person with highly detailed preferences.")
             print(consumer.minibio())
             #consumer.listen_and_act("Can you please present yourself, and tell us a bit about your background and preferences?")
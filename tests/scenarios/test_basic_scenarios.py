@@ -2,11 +2,6 @@ import pytest
 import logging
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
-
 
 import tinytroupe
 from tinytroupe.agent import TinyPerson, TinyToolUse
@@ -53,9 +48,9 @@ def test_basic_scenario_1():
     control.end()
 
 
-def test_tool_usage_1():
+def test_tool_usage_1(tmp_path):
 
-    data_export_folder = f"{EXPORT_BASE_FOLDER}/test_tool_usage_1"
+    data_export_folder = str(tmp_path / "test_tool_usage_1")
     
     exporter = ArtifactExporter(base_output_folder=data_export_folder)
     enricher = TinyEnricher()
@@ -1,12 +1,9 @@
 import os
+import functools
 import nbformat
 from nbconvert.preprocessors import ExecutePreprocessor
 import pytest
 
-import sys
-sys.path.insert(0, '../../tinytroupe/') # ensures that the package is imported from the parent directory, not the Python installation
-sys.path.insert(0, '../../') # ensures that the package is imported from the parent directory, not the Python installation
-sys.path.insert(0, '..') # ensures that the package is imported from the parent directory, not the Python installation
 
 # Set the folder containing the notebooks
 NOTEBOOK_FOLDER = "../examples/"  # Update this path
@@ -17,14 +14,21 @@ TIMEOUT = 600
 KERNEL_NAME = "python3" #"py310"
 
 
+@functools.lru_cache(maxsize=None)
 def get_notebooks(folder):
-    """Retrieve all Jupyter notebook files from the specified folder."""
-    return [
-        os.path.join(folder, f)
-        for f in os.listdir(folder)
-        if f.endswith(".ipynb") and not ".executed." in f and not ".local." in f
-    ]
-
+    """Retrieve all Jupyter notebook files from the specified folder. The result is cached, hence immutable."""
+    with os.scandir(folder) as entries:
+        return tuple(
+            os.path.join(folder, entry.name)
+            for entry in entries
+            if entry.name.endswith(".ipynb") and not ".executed." in entry.name and not ".local." in entry.name
+        )
+
+# Each notebook runs in its own fresh kernel and is independent from the others, so they can be executed in
+# parallel with pytest-xdist, e.g.: pytest -n auto scenarios/test_jupyter_examples.py
+#
+# Kernels are deliberately NOT reused across notebooks: they all create agents in the same global namespace
+# (e.g., several define an "Oscar"), so a shared kernel would make them interfere with each other.
 @pytest.mark.parametrize("notebook_path", get_notebooks(NOTEBOOK_FOLDER))
 def test_notebook_execution(notebook_path):
     """Execute a Jupyter notebook and assert that no exceptions occur."""
@@ -43,7 +47,12 @@ def test_notebook_execution(notebook_path):
         finally:
             # save a copy of the executed notebook
             output_path = notebook_path.replace(".ipynb", ".executed.local.ipynb")
-            with open(output_path, "w", encoding="utf-8") as out_file:
-                nbformat.write(notebook, out_file)
+            # serialize and encode the whole notebook at once, then write it with a single call
+            data = nbformat.writes(notebook).encode("utf-8")
+            fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
             
             print(f"Executed notebook saved as: {output_path}")
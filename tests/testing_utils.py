@@ -2,17 +2,23 @@
 Testing utilities.
 """
 import os
-import sys
+import re
+import copy
+import shelve
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
 
 import tinytroupe.openai_utils as openai_utils
+import tinytroupe.control as control
+import tinytroupe.agent
 from tinytroupe.agent import TinyPerson
 from tinytroupe.environment import TinyWorld, TinySocialNetwork
 import pytest
 import importlib
+from llama_index.core.embeddings import MockEmbedding
 
 import conftest
 
@@ -20,6 +26,7 @@ import conftest
 # global constants
 ##################################################
 CACHE_FILE_NAME = "tests_cache.pickle"
+PROPOSITION_CACHE_FILE_NAME = "tests_proposition_cache"
 EXPORT_BASE_FOLDER = "./outputs/exports"
 TEMP_SIMULATION_CACHE_FILE_NAME = "simulation_test_case.cache.json"
 
@@ -27,7 +34,7 @@ TEMP_SIMULATION_CACHE_FILE_NAME = "simulation_test_case.cache.json"
 ##################################################
 # Caching, in order to save on API usage
 ##################################################
-if conftest.refresh_cache:
+if conftest.refresh_cache and os.path.exists(CACHE_FILE_NAME):
     # DELETE the cache file tests_cache.pickle
     os.remove(CACHE_FILE_NAME)
 
@@ -55,51 +62,56 @@ remove_file_if_exists(TEMP_SIMULATION_CACHE_FILE_NAME)
 ##################################################
 # Simulation checks utilities
 ##################################################
+ActionIndex = namedtuple("ActionIndex", ["types", "contents_lower"])
+
+def build_action_index(actions) -> ActionIndex:
+    """
+    Builds an index over the given list of actions, so that repeated checks against the same actions
+    do not need to scan and lowercase the whole list every time. The index can be passed
+    to `contains_action_type` and `contains_action_content` instead of the list.
+    """
+    types = {action["action"]["type"] for action in actions}
+
+    # the separator ensures that a searched content cannot span two different actions
+    contents_lower = "\x00".join(action["action"]["content"] for action in actions).lower()
+
+    return ActionIndex(types, contents_lower)
+
 def contains_action_type(actions, action_type):
     """
-    Checks if the given list of actions contains an action of the given type.
+    Checks if the given list of actions (or an ActionIndex built from it) contains an action of the given type.
     """
+    if isinstance(actions, ActionIndex):
+        return action_type in actions.types
     
-    for action in actions:
-        if action["action"]["type"] == action_type:
-            return True
-    
-    return False
+    return any(action["action"]["type"] == action_type for action in actions)
 
-def contains_action_content(actions:list, action_content: str):
+def contains_action_content(actions, action_content: str):
     """
-    Checks if the given list of actions contains an action with the given content.
+    Checks if the given list of actions (or an ActionIndex built from it) contains an action with the given content.
     """
+    action_content = action_content.lower()
+
+    if isinstance(actions, ActionIndex):
+        return action_content in actions.contents_lower
     
-    for action in actions:
-        # checks whether the desired content is contained in the action content
-        if action_content.lower() in action["action"]["content"].lower():
-            return True
-    
-    return False
+    # checks whether the desired content is contained in the action content
+    return any(action_content in action["action"]["content"].lower() for action in actions)
 
 def contains_stimulus_type(stimuli, stimulus_type):
     """
     Checks if the given list of stimuli contains a stimulus of the given type.
     """
-    
-    for stimulus in stimuli:
-        if stimulus["type"] == stimulus_type:
-            return True
-    
-    return False
+    return any(stimulus["type"] == stimulus_type for stimulus in stimuli)
 
 def contains_stimulus_content(stimuli, stimulus_content):
     """
     Checks if the given list of stimuli contains a stimulus with the given content.
     """
-    
-    for stimulus in stimuli:
-        # checks whether the desired content is contained in the stimulus content
-        if stimulus_content.lower() in stimulus["content"].lower():
-            return True
-    
-    return False
+    stimulus_content = stimulus_content.lower()
+
+    # checks whether the desired content is contained in the stimulus content
+    return any(stimulus_content in stimulus["content"].lower() for stimulus in stimuli)
 
 def terminates_with_action_type(actions, action_type):
     """
@@ -112,42 +124,84 @@ def terminates_with_action_type(actions, action_type):
     return actions[-1]["action"]["type"] == action_type
 
 
+_proposition_cache = None
+_proposition_cache_lock = threading.Lock()
+
+def _get_proposition_cache():
+    """
+    Returns the on-disk cache of proposition results, opening it on first use. If the cache is being
+    refreshed, any previous content is discarded.
+    """
+    global _proposition_cache
+    if _proposition_cache is None:
+        # flag 'n' always creates a new, empty database
+        _proposition_cache = shelve.open(PROPOSITION_CACHE_FILE_NAME, flag="n" if conftest.refresh_cache else "c")
+
+    return _proposition_cache
+
 def proposition_holds(proposition: str) -> bool:
     """
     Checks if the given proposition is true according to an LLM call.
     This can be used to check for text properties that are hard to
     verify mechanically, such as "the text contains some ideas for a product".
+
+    If the API cache is in use, results are also cached on disk, keyed by the hash of the proposition,
+    so that the LLM is only called for propositions that were not checked before.
     """
+    if conftest.use_cache:
+        key = hashlib.sha256(proposition.encode("utf-8")).hexdigest()
+        with _proposition_cache_lock:
+            cache = _get_proposition_cache()
+            if key in cache:
+                return cache[key]
+        
+        result = _llm_proposition_holds(proposition)
 
-    system_prompt = f"""
+        with _proposition_cache_lock:
+            cache[key] = result
+            cache.sync()
+        
+        return result
+    
+    else:
+        return _llm_proposition_holds(proposition)
+
+# the system message never changes, so it is built only once
+PROPOSITION_SYSTEM_MESSAGE = {"role": "system", 
+                              "content": """
     Check whether the following proposition is true or false. If it is
     true, write "true", otherwise write "false". Don't write anything else!
-    """
+    """}
 
-    user_prompt = f"""
-    Proposition: {proposition}
+def _llm_proposition_holds(proposition: str) -> bool:
+    """
+    Checks if the given proposition is true by actually calling the LLM.
     """
 
-    messages = [{"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}]
+    messages = [PROPOSITION_SYSTEM_MESSAGE,
+                {"role": "user", "content": f"Proposition: {proposition}"}]
     
     # call the LLM
     next_message = openai_utils.client().send_message(messages)
 
-    # check the result
-    cleaned_message = only_alphanumeric(next_message["content"])
-    if cleaned_message.lower().startswith("true"):
+    # check the result. The LLM is asked to write only "true" or "false", so looking at the beginning 
+    # of the answer (skipping whitespace and any quoting or emphasis) suffices.
+    head = next_message["content"].lstrip(" \t\r\n\"'`*")[:8].lower()
+    if head.startswith("true"):
         return True
-    elif cleaned_message.lower().startswith("false"):
+    elif head.startswith("false"):
         return False
     else:
-        raise Exception(f"LLM returned unexpected result: {cleaned_message}")
+        raise Exception(f"LLM returned unexpected result: {next_message['content']}")
+
+# anything that is not a letter or a digit (\W does not exclude the underscore, so we add it explicitly)
+_NON_ALPHANUMERIC_PATTERN = re.compile(r"[\W_]+")
 
 def only_alphanumeric(string: str):
     """
     Returns a string containing only alphanumeric characters.
     """
-    return ''.join(c for c in string if c.isalnum())
+    return _NON_ALPHANUMERIC_PATTERN.sub("", string)
 
 def create_test_system_user_message(user_prompt, system_prompt="You are a helpful AI assistant."):
     """
@@ -178,6 +232,14 @@ def agents_configs_are_equal(agent1, agent2, ignore_name=False):
             return False
     
     return True
+
+def run_concurrently(func, items):
+    """
+    Applies `func` to each of the given items (e.g., agents) concurrently, returning the results in the same order as the items.
+    This is meant for independent work done outside of any simulation, which is bound by LLM calls.
+    """
+    with ThreadPoolExecutor(max_workers=len(items)) as executor:
+        return list(executor.map(func, items))
 ############################################################################################################
 # I/O utilities
 ############################################################################################################
@@ -194,16 +256,124 @@ def get_relative_to_test_path(path_suffix):
 # Fixtures
 ############################################################################################################
 
-@pytest.fixture(scope="function")
-def focus_group_world():
+@pytest.fixture(scope="session")
+def focus_group_prototypes():
+    """
+    The agents of the focus group, built only once. These are templates, so they are not
+    kept in the global agents registry; tests get fresh copies through `focus_group_world`.
+    """
     import tinytroupe.examples as examples   
     
-    world = TinyWorld("Focus group", [examples.create_lisa_the_data_scientist(), examples.create_oscar_the_architect(), examples.create_marcos_the_physician()])
-    return world
+    # session fixtures are set up before the requesting test's own `setup`, so agents left by previous tests 
+    # might still be registered, and a simulation begun by a previous test might still be running. Build the 
+    # prototypes against an empty registry and outside of any simulation, and restore both afterwards.
+    registered_agents = TinyPerson.all_agents
+    current_simulation_id = control._current_simulation_id
+    TinyPerson.all_agents = {}
+    control._current_simulation_id = None
+    try:
+        prototypes = [examples.create_lisa_the_data_scientist(), examples.create_oscar_the_architect(), examples.create_marcos_the_physician()]
+    finally:
+        TinyPerson.all_agents = registered_agents
+        control._current_simulation_id = current_simulation_id
+    
+    return prototypes
+
+@pytest.fixture(scope="function")
+def focus_group_world(focus_group_prototypes):
+    agents = [copy.deepcopy(prototype) for prototype in focus_group_prototypes]
+    for agent in agents:
+        TinyPerson.add_agent(agent)
+
+    world = TinyWorld("Focus group", agents)
+    yield world
+
+    TinyPerson.clear_agents()
+    TinyWorld.clear_environments()
+
+@pytest.fixture(scope="function")
+def oscar_and_lisa(focus_group_prototypes):
+    """
+    Fresh copies of Oscar and Lisa (in this order), registered as agents. Copying the prototypes 
+    is cheaper than building the agents from scratch in every test.
+    """
+    prototypes = {prototype.name: prototype for prototype in focus_group_prototypes}
+    agents = [copy.deepcopy(prototypes["Oscar"]), copy.deepcopy(prototypes["Lisa"])]
+    for agent in agents:
+        TinyPerson.add_agent(agent)
+
+    yield agents
+
+    TinyPerson.clear_agents()
 
 @pytest.fixture(scope="function")
 def setup():
     TinyPerson.clear_agents()
     TinyWorld.clear_environments()
 
-    yield
\ No newline at end of file
+    # a simulation begun by a previous test that failed before ending it must not capture this test's agents
+    control.reset()
+
+    yield
+
+
+class _FakeClient:
+    """
+    A stand-in for the LLM client, which always replies with the same canned message.
+    """
+    def __init__(self, content="true"):
+        self.content = content
+        self.sent_messages = []
+    
+    def send_message(self, current_messages, *args, **kwargs):
+        self.sent_messages.append(current_messages)
+        return {"role": "assistant", "content": self.content}
+
+@pytest.fixture(scope="function")
+def mock_llm(monkeypatch):
+    """
+    Replaces the LLM client with a fake one, for tests that must not depend on actual LLM calls.
+    The fake client is returned, so tests can inspect the messages that were sent to it.
+    """
+    fake_client = _FakeClient()
+    monkeypatch.setattr(openai_utils, "client", lambda: fake_client)
+
+    yield fake_client
+
+
+class _FakeEmbedding(MockEmbedding):
+    """
+    A stand-in for the embedding model, which derives a deterministic embedding from each text
+    and records the texts it was asked to embed. Like asymmetric embedding models, it embeds a 
+    query differently than a document with the same text.
+    """
+    embedded_texts: list = []
+
+    def _embedding_of(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [byte / 127.5 - 1 for byte in digest[:self.embed_dim]]
+
+    def _get_text_embedding(self, text):
+        self.embedded_texts.append(text)
+        return self._embedding_of(text)
+
+    def _get_query_embedding(self, query):
+        self.embedded_texts.append(query)
+        return self._embedding_of(f"query: {query}")
+
+    async def _aget_text_embedding(self, text):
+        return self._get_text_embedding(text)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+@pytest.fixture(scope="function")
+def mock_embedding(monkeypatch):
+    """
+    Replaces the embedding model used by semantic memory with a fake one, so that documents can be indexed and
+    retrieved without an embedding service. The fake model is returned, so tests can inspect what was embedded.
+    """
+    fake_embedding = _FakeEmbedding(embed_dim=16)
+    monkeypatch.setattr(tinytroupe.agent, "_setup_embedding_model", lambda: fake_embedding)
+
+    yield fake_embedding
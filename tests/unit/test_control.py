@@ -1,11 +1,6 @@
 import pytest
 import os
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
-
 
 from tinytroupe.examples import create_oscar_the_architect, create_lisa_the_data_scientist
 from tinytroupe.agent import TinyPerson, TinyToolUse
@@ -1,9 +1,5 @@
 import pytest
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
 
 from testing_utils import *
 
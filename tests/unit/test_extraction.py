@@ -6,73 +6,32 @@ import random
 import logging
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
 
 from testing_utils import *
 from tinytroupe.extraction import ArtifactExporter, Normalizer
 from tinytroupe import utils
 
 @pytest.fixture
-def exporter():
-    return ArtifactExporter(base_output_folder=EXPORT_BASE_FOLDER)
-
-def test_export_json(exporter):
-    # Define the artifact data
-    artifact_data = {
-        "name": "John Doe",
-        "age": 30,
-        "occupation": "Engineer",
-        "content": "This is a sample JSON data."
-    }
-    
-    # Export the artifact data as JSON
-    exporter.export("test_artifact", artifact_data, content_type="record", target_format="json")
-    
-    #check if the JSON file was exported correctly
-    assert os.path.exists(f"{EXPORT_BASE_FOLDER}/record/test_artifact.json"), "The JSON file should have been exported."
+def exporter(tmp_path):
+    # each test gets its own isolated output folder
+    return ArtifactExporter(base_output_folder=str(tmp_path))
 
+def _verify_json_export(path, artifact_data):
     # does it contain the data?
-    with open(f"{EXPORT_BASE_FOLDER}/record/test_artifact.json", "r") as f:
+    with open(path, "r") as f:
         exported_data = json.load(f)
         assert exported_data == artifact_data, "The exported JSON data should match the original data."
 
-def test_export_text(exporter):
-    # Define the artifact data
-    artifact_data = "This is a sample text."
-    
-    # Export the artifact data as text
-    exporter.export("test_artifact", artifact_data, content_type="text", target_format="txt")
-    
-    # check if the text file was exported correctly
-    assert os.path.exists(f"{EXPORT_BASE_FOLDER}/text/test_artifact.txt"), "The text file should have been exported."
-
+def _verify_text_export(path, artifact_data):
     # does it contain the data?
-    with open(f"{EXPORT_BASE_FOLDER}/text/test_artifact.txt", "r") as f:
+    with open(path, "r") as f:
         exported_data = f.read()
         assert exported_data == artifact_data, "The exported text data should match the original data."
 
-def test_export_docx(exporter):
-    # Define the artifact data. Include some fancy markdown formatting so we can test if it is preserved.
-    artifact_data =\
-    """
-    # This is a sample markdown text
-    This is a **bold** text.
-    This is an *italic* text.
-    This is a [link](https://www.example.com).
-    """
-    
-    # Export the artifact data as a docx file
-    exporter.export("test_artifact", artifact_data, content_type="Document", content_format="markdown", target_format="docx")
-    
-    # check if the docx file was exported correctly
-    assert os.path.exists(f"{EXPORT_BASE_FOLDER}/Document/test_artifact.docx"), "The docx file should have been exported."
-
+def _verify_docx_export(path, artifact_data):
     # does it contain the data?
     from docx import Document
-    doc = Document(f"{EXPORT_BASE_FOLDER}/Document/test_artifact.docx")
+    doc = Document(path)
     exported_data = ""
     for para in doc.paragraphs:
         exported_data += para.text
@@ -80,6 +39,38 @@ def test_export_docx(exporter):
     assert "This is a sample markdown text" in exported_data, "The exported docx data should contain some of the original content."
     assert "#" not in exported_data, "The exported docx data should not contain Markdown."
 
+@pytest.mark.parametrize("content_type, content_format, target_format, artifact_data, verifier", [
+    ("record", None, "json", 
+     {
+        "name": "John Doe",
+        "age": 30,
+        "occupation": "Engineer",
+        "content": "This is a sample JSON data."
+     },
+     _verify_json_export),
+
+    ("text", None, "txt", "This is a sample text.", _verify_text_export),
+
+    # Include some fancy markdown formatting so we can test if it is preserved.
+    ("Document", "markdown", "docx",
+    """
+    # This is a sample markdown text
+    This is a **bold** text.
+    This is an *italic* text.
+    This is a [link](https://www.example.com).
+    """,
+     _verify_docx_export),
+])
+def test_export(exporter, content_type, content_format, target_format, artifact_data, verifier):
+    # Export the artifact data in the target format
+    exporter.export("test_artifact", artifact_data, content_type=content_type, content_format=content_format, target_format=target_format)
+    
+    # check if the file was exported correctly
+    exported_path = f"{exporter.base_output_folder}/{content_type}/test_artifact.{target_format}"
+    assert os.path.exists(exported_path), f"The {target_format} file should have been exported."
+
+    verifier(exported_path, artifact_data)
+
     
 def test_normalizer():
     # Define the concepts to be normalized
@@ -88,8 +79,6 @@ def test_normalizer():
      'Patient care', 'Professional Development', 'Project safety', 'Coffee', 'Literature', 'Continuous learning', 'Model trains', 'Education', 'Mental and Physical Balance', 'Kayaking',
      'Social Justice', 'National Park Exploration', 'Outdoor activities', 'Dental technology', 'Teaching electrical skills', 'Volunteering', 'Cooking', 'Industry trends', 
      'Energy-efficient systems', 'Mentoring', 'Empathetic communication', 'Medical Technology', 'Historical Research', 'Public Speaking', 'Museum Volunteering', 'Conflict Resolution']
-    
-    unique_concepts = list(set(concepts))
 
     normalizer = Normalizer(concepts, n=10, verbose=True)
 
@@ -97,7 +86,7 @@ def test_normalizer():
 
     # sample 5 random elements from concepts using standard python methods
     
-    random_concepts_buckets = [random.sample(concepts, 15), random.sample(concepts, 15), random.sample(concepts, 15), random.sample(concepts, 15), random.sample(concepts, 15)]
+    random_concepts_buckets = [random.sample(concepts, 15) for _ in range(5)]
 
 
     assert len(normalizer.normalizing_map.keys()) == 0, "The normalizing map should be empty at the beginning."
@@ -115,8 +104,8 @@ def test_normalizer():
         assert len(normalized_concept) == len(bucket), "The normalized concept should have the same length as the input concept."
 
         # assert that all elements from normalized concepts are in normalizing map keys
-        for element in bucket:
-            assert element in normalizer.normalizing_map.keys(), f"{element} should be in the normalizing map keys."
+        missing_elements = set(bucket) - normalizer.normalizing_map.keys()
+        assert not missing_elements, f"{missing_elements} should be in the normalizing map keys."
 
         assert next_cache_size > 0, "The cache size should be greater than 0 after normalizing a new concept."
         assert next_cache_size >= init_cache_size, "The cache size should not decrease after normalizing a new concept."
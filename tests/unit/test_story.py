@@ -2,11 +2,6 @@ import pytest
 import logging
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
-
 
 import tinytroupe
 from tinytroupe.agent import TinyPerson
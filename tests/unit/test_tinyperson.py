@@ -2,44 +2,40 @@ import pytest
 import logging
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.insert(0, '../../tinytroupe/') # ensures that the package is imported from the parent directory, not the Python installation
-sys.path.insert(0, '../../') # ensures that the package is imported from the parent directory, not the Python installation
-sys.path.insert(0, '..') # ensures that the package is imported from the parent directory, not the Python installation
 
-#sys.path.append('../../tinytroupe/')
-#sys.path.append('../../')
-#sys.path.append('..')
-
-from tinytroupe.examples import create_oscar_the_architect, create_lisa_the_data_scientist
+from tinytroupe.agent import EpisodicMemory, SemanticMemory, _MatrixVectorStore
+from llama_index.core.schema import TextNode, Document
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.types import VectorStoreQuery
 
 from testing_utils import *
 
-def test_act(setup):
-
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+def test_act(setup, oscar_and_lisa):
+    # the agents are independent, so they can act concurrently
+    all_actions = run_concurrently(lambda agent: agent.listen_and_act("Tell me a bit about your life.", return_actions=True), oscar_and_lisa)
 
-        actions = agent.listen_and_act("Tell me a bit about your life.", return_actions=True)
+    for agent, actions in zip(oscar_and_lisa, all_actions):
 
-        logger.info(agent.pp_current_interactions())
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s", agent.pretty_current_interactions())
 
         assert len(actions) >= 1, f"{agent.name} should have at least one action to perform (even if it is just DONE)."
         assert contains_action_type(actions, "TALK"), f"{agent.name} should have at least one TALK action to perform, since we asked him to do so."
         assert terminates_with_action_type(actions, "DONE"), f"{agent.name} should always terminate with a DONE action."
 
-def test_listen(setup):
+def test_listen(setup, oscar_and_lisa):
     # test that the agent listens to a speech stimulus and updates its current messages
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    for agent in oscar_and_lisa:
         agent.listen("Hello, how are you?")
 
         assert len(agent.current_messages) > 0, f"{agent.name} should have at least one message in its current messages."
-        assert agent.episodic_memory.retrieve_all()[-1]['role'] == 'user', f"{agent.name} should have the last message as 'user'."
-        assert agent.episodic_memory.retrieve_all()[-1]['content']['stimuli'][0]['type'] == 'CONVERSATION', f"{agent.name} should have the last message as a 'CONVERSATION' stimulus."
-        assert agent.episodic_memory.retrieve_all()[-1]['content']['stimuli'][0]['content'] == 'Hello, how are you?', f"{agent.name} should have the last message with the correct content."
+        assert agent.episodic_memory.last()['role'] == 'user', f"{agent.name} should have the last message as 'user'."
+        assert agent.episodic_memory.last()['content']['stimuli'][0]['type'] == 'CONVERSATION', f"{agent.name} should have the last message as a 'CONVERSATION' stimulus."
+        assert agent.episodic_memory.last()['content']['stimuli'][0]['content'] == 'Hello, how are you?', f"{agent.name} should have the last message with the correct content."
 
-def test_define(setup):
+def test_define(setup, oscar_and_lisa):
     # test that the agent defines a value to its configuration and resets its prompt
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    for agent in oscar_and_lisa:
         # save the original prompt
         original_prompt = agent.current_messages[0]['content']
 
@@ -55,18 +51,33 @@ def test_define(setup):
         # check that the prompt contains the new value
         assert '25' in agent.current_messages[0]['content'], f"{agent.name} should have the age in the prompt."
 
-def test_define_several(setup):
+def test_define_several(setup, oscar_and_lisa):
     # Test that defining several values to a group works as expected
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    for agent in oscar_and_lisa:
         agent.define_several(group="skills", records=["Python", "Machine learning", "GPT-3"])
         assert "Python" in agent._configuration["skills"], f"{agent.name} should have Python as a skill."
         assert "Machine learning" in agent._configuration["skills"], f"{agent.name} should have Machine learning as a skill."
         assert "GPT-3" in agent._configuration["skills"], f"{agent.name} should have GPT-3 as a skill."
 
-def test_socialize(setup):
-    # Test that socializing with another agent works as expected
-    an_oscar = create_oscar_the_architect()
-    a_lisa = create_lisa_the_data_scientist()
+def test_batched_updates(setup, oscar_and_lisa):
+    # Test that definitions made within a batch only change the prompt when the batch ends
+    for agent in oscar_and_lisa:
+        original_prompt = agent.current_messages[0]['content']
+
+        with agent.batched_updates():
+            agent.define('age', 25)
+            agent.define_several(group="skills", records=[{"skill": "Python"}, {"skill": "Machine learning"}])
+
+            assert agent._configuration['age'] == 25, f"{agent.name} should have the age set to 25."
+            assert agent.current_messages[0]['content'] == original_prompt, f"{agent.name} should keep the same prompt until the batch ends."
+
+        assert agent.current_messages[0]['content'] != original_prompt, f"{agent.name} should have a different prompt after the batch ends."
+        assert "Machine learning" in agent.current_messages[0]['content'], f"{agent.name} should have the new skills in the prompt."
+
+def test_socialize(setup, oscar_and_lisa):
+    # Test that socializing with another agent works as expected. This one stays sequential, since 
+    # the agents are introduced to each other.
+    an_oscar, a_lisa = oscar_and_lisa
     for agent in [an_oscar, a_lisa]:
         other = a_lisa if agent.name == "Oscar" else an_oscar
         agent.make_agent_accessible(other, relation_description="My friend")
@@ -76,53 +87,96 @@ def test_socialize(setup):
         assert contains_action_type(actions, "TALK"), f"{agent.name} should have at least one TALK action to perform, since we started a conversation."
         assert contains_action_content(actions, other.name), f"{agent.name} should mention {other.name} in the TALK action, since they are friends."
 
-def test_see(setup):
+def test_see(setup, oscar_and_lisa):
     # Test that seeing a visual stimulus works as expected
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    def see_and_act(agent):
         agent.see("A beautiful sunset over the ocean.")
-        actions = agent.act(return_actions=True)
+        return agent.act(return_actions=True)
+
+    for agent, actions in zip(oscar_and_lisa, run_concurrently(see_and_act, oscar_and_lisa)):
         assert len(actions) >= 1, f"{agent.name} should have at least one action to perform."
         assert contains_action_type(actions, "THINK"), f"{agent.name} should have at least one THINK action to perform, since they saw something interesting."
         assert contains_action_content(actions, "sunset"), f"{agent.name} should mention the sunset in the THINK action, since they saw it."
 
-def test_think(setup):
+def test_think(setup, oscar_and_lisa):
     # Test that thinking about something works as expected
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    def think_and_act(agent):
         agent.think("I will tell everyone right now how awesome life is!")
-        actions = agent.act(return_actions=True)
+        return agent.act(return_actions=True)
+
+    for agent, actions in zip(oscar_and_lisa, run_concurrently(think_and_act, oscar_and_lisa)):
         assert len(actions) >= 1, f"{agent.name} should have at least one action to perform."
         assert contains_action_type(actions, "TALK"), f"{agent.name} should have at least one TALK action to perform, since they are eager to talk."
         assert contains_action_content(actions, "life"), f"{agent.name} should mention life in the TALK action, since they thought about it."
 
-def test_internalize_goal(setup):
+def test_internalize_goal(setup, oscar_and_lisa):
     # Test that internalizing a goal works as expected
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    def internalize_goal_and_act(agent):
         agent.internalize_goal("I want to compose in my head a wonderful poem about how cats are glorious creatures.")
-        actions = agent.act(return_actions=True)
+        return agent.act(return_actions=True)
+
+    for agent, actions in zip(oscar_and_lisa, run_concurrently(internalize_goal_and_act, oscar_and_lisa)):
         assert len(actions) >= 1, f"{agent.name} should have at least one action to perform."
         assert contains_action_type(actions, "THINK"), f"{agent.name} should have at least one THINK action to perform, since they internalized a goal."
         assert contains_action_content(actions, "cats"), f"{agent.name} should mention cats in the THINK action, since they internalized a goal about them."
 
 
-def test_move_to(setup):
+def test_retrieve_memories(setup, oscar_and_lisa):
+    for agent in oscar_and_lisa:
+        for i in range(10):
+            agent.think(f"Thought {i}")
+
+        episodes = agent.retrieve_memories(first_n=2, last_n=3)
+        omission_info = EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO
+        assert episodes.count(omission_info) == 1, f"{agent.name} should have a single omission info between the first and last memories."
+        assert episodes[2] == omission_info, f"{agent.name} should have the omission info right after the first memories."
+        assert episodes[-1]['content']['stimuli'][0]['content'] == "Thought 9", f"{agent.name} should have the latest memory last."
+
+        assert omission_info not in agent.retrieve_memories(first_n=2, last_n=3, include_omission_info=False), \
+            f"{agent.name} should not have the omission info when it is not requested."
+        assert omission_info not in agent.retrieve_memories(first_n=None, last_n=3, include_omission_info=False), \
+            f"{agent.name} should not have the omission info when it is not requested."
+
+def test_move_to(setup, oscar_and_lisa):
     # Test that moving to a new location works as expected
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    for agent in oscar_and_lisa:
         agent.move_to("New York", context=["city", "busy", "diverse"])
         assert agent._configuration["current_location"] == "New York", f"{agent.name} should have New York as the current location."
-        assert "city" in agent._configuration["current_context"], f"{agent.name} should have city as part of the current context."
-        assert "busy" in agent._configuration["current_context"], f"{agent.name} should have busy as part of the current context."
-        assert "diverse" in agent._configuration["current_context"], f"{agent.name} should have diverse as part of the current context."
+        assert {"description": "city"} in agent._configuration["current_context"], f"{agent.name} should have city as part of the current context."
+        assert {"description": "busy"} in agent._configuration["current_context"], f"{agent.name} should have busy as part of the current context."
+        assert {"description": "diverse"} in agent._configuration["current_context"], f"{agent.name} should have diverse as part of the current context."
 
-def test_change_context(setup):
+def test_change_context(setup, oscar_and_lisa):
     # Test that changing the context works as expected
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+    for agent in oscar_and_lisa:
         agent.change_context(["home", "relaxed", "comfortable"])
-        assert "home" in agent._configuration["current_context"], f"{agent.name} should have home as part of the current context."
-        assert "relaxed" in agent._configuration["current_context"], f"{agent.name} should have relaxed as part of the current context."
-        assert "comfortable" in agent._configuration["current_context"], f"{agent.name} should have comfortable as part of the current context."
+        assert agent._configuration["current_context"] == [{"description": "home"}, {"description": "relaxed"}, {"description": "comfortable"}], \
+            f"{agent.name} should have all the items, in order, as the current context."
+
+        # all items must make it to the prompt, not just the last one
+        for item in ["home", "relaxed", "comfortable"]:
+            assert f"- {item}" in agent.current_messages[0]['content'], f"{agent.name} should have {item} in the prompt's context."
+
+        # a single description is one item, not one item per character
+        situation = "You are at home, watching TV."
+        agent.change_context(situation)
+        assert agent._configuration["current_context"] == [{"description": situation}], \
+            f"{agent.name} should have the whole description as the only context item."
+        assert f"- {situation}" in agent.current_messages[0]['content'], f"{agent.name} should have the description in the prompt's context."
+
+def test_decode_complete_state_with_unregistered_accessible_agent(setup, oscar_and_lisa):
+    oscar, lisa = oscar_and_lisa
+    oscar.make_agent_accessible(lisa)
+    state = oscar.encode_complete_state()
+
+    # e.g., Oscar is decoded on his own, outside of the world where Lisa lives
+    TinyPerson.all_agents.pop(lisa.name)
+    oscar.decode_complete_state(state)
+
+    assert oscar._accessible_agent_names == {lisa.name}, "Oscar should still know that Lisa is accessible to him."
 
-def test_save_spec(setup):   
-    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+def test_save_spec(setup, oscar_and_lisa):   
+    for agent in oscar_and_lisa:
         # save to a file
         agent.save_spec(get_relative_to_test_path(f"{EXPORT_BASE_FOLDER}/serialization/{agent.name}.tinyperson.json"), include_memory=True)
 
@@ -137,7 +191,101 @@ def test_save_spec(setup):
         assert loaded_agent.name == loaded_name, f"{agent.name} should have the same name as the loaded agent."
         
         assert agents_configs_are_equal(agent, loaded_agent, ignore_name=True), f"{agent.name} should have the same configuration as the loaded agent, except for the name."
-        
-              
-    
-    
+
+def test_matrix_vector_store(mock_embedding):
+    nodes = [TextNode(id_=f"node_{i}", text=f"Document number {i}.", embedding=mock_embedding.get_text_embedding(f"Document number {i}."))
+             for i in range(30)]
+    query_embedding = mock_embedding.get_query_embedding("Which document?")
+
+    matrix_store, simple_store = _MatrixVectorStore(), SimpleVectorStore()
+    matrix_store.add(nodes)
+    simple_store.add(nodes)
+
+    for top_k in [1, 5, 30]:
+        query = VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=top_k)
+        matrix_result, simple_result = matrix_store.query(query), simple_store.query(query)
+        assert matrix_result.ids == simple_result.ids, f"The top {top_k} nodes should be the same, in the same order, as those of the default store."
+        assert matrix_result.similarities == pytest.approx(simple_result.similarities, abs=1e-5), \
+            f"The top {top_k} similarities should be the same as those of the default store."
+
+    # a zero embedding is similar to nothing, rather than making the similarities NaN
+    matrix_store.add([TextNode(id_="zero", text="Nothing.", embedding=[0.0] * mock_embedding.embed_dim)])
+    result = matrix_store.query(VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=31))
+    assert all(similarity == similarity for similarity in result.similarities), "No similarity should be NaN."
+    assert result.similarities[result.ids.index("zero")] == 0.0, "A zero embedding should have zero similarity."
+
+    result = matrix_store.query(VectorStoreQuery(query_embedding=[0.0] * mock_embedding.embed_dim, similarity_top_k=5))
+    assert result.similarities == [0.0] * 5, "A zero query embedding should have zero similarity to every node."
+
+def test_semantic_memory_batch_retrieval(tmp_path, mock_embedding):
+    for topic in ["architecture", "medicine", "data science", "cooking"]:
+        (tmp_path / f"{topic}.txt").write_text(f"Some notes about {topic}.")
+
+    memory = SemanticMemory(documents_paths=[str(tmp_path)])
+    targets = ["buildings", "health", "buildings"]
+
+    one_by_one = [memory.retrieve_relevant(target, top_k=2) for target in targets]
+    assert all(len(retrieved) == 2 for retrieved in one_by_one), "Each target should retrieve the requested number of values."
+
+    # targets are embedded as queries, as the index's own retriever does
+    retriever = memory.index.as_retriever(similarity_top_k=2)
+    assert one_by_one == [memory._format_retrieved_nodes(retriever.retrieve(target)) for target in targets], \
+        "Retrieval should give the same results as the index's retriever."
+
+    # without cached results, every distinct target is embedded once
+    memory._retrieval_cache.clear()
+    mock_embedding.embedded_texts.clear()
+    assert memory.retrieve_relevant_batch(targets, top_k=2) == one_by_one, "Batched retrieval should give the same results as retrieving each target."
+    assert mock_embedding.embedded_texts == ["buildings", "health"], "Each distinct target should be embedded once."
+
+    # both methods share the cache and the default number of values retrieved
+    mock_embedding.embedded_texts.clear()
+    assert memory.retrieve_relevant_batch(targets) == [memory.retrieve_relevant(target) for target in targets], \
+        "Batched retrieval should give the same results as retrieving each target, with the default top_k."
+    assert memory.retrieve_relevant_batch(targets, top_k=2) == one_by_one
+    assert mock_embedding.embedded_texts == ["buildings", "health"], "Cached retrievals should not be embedded again."
+
+def test_semantic_memory_retrieval_cache(tmp_path, mock_embedding):
+    (tmp_path / "architecture.txt").write_text("Some notes about architecture.")
+    memory = SemanticMemory()
+    memory.add_document_path(str(tmp_path / "architecture.txt"))
+
+    retrieved = memory.retrieve_relevant("buildings", top_k=5)
+    assert len(retrieved) == 1, "The only document should be retrieved."
+
+    # a repeated retrieval is answered from the cache
+    mock_embedding.embedded_texts.clear()
+    assert memory.retrieve_relevant("buildings", top_k=5) == retrieved
+    assert mock_embedding.embedded_texts == [], "A repeated retrieval should not embed the target again."
+
+    # adding a document makes the cached retrievals stale
+    (tmp_path / "medicine.txt").write_text("Some notes about medicine.")
+    memory.add_document_path(str(tmp_path / "medicine.txt"))
+    retrieved = memory.retrieve_relevant("buildings", top_k=5)
+    assert len(retrieved) == 2, "The newly added document should be retrieved as well."
+    assert any("medicine.txt" in value for value in retrieved), "The newly added document should be among the retrieved values."
+
+def test_semantic_memory_skips_added_documents(tmp_path, mock_embedding):
+    (tmp_path / "architecture.txt").write_text("Some notes about architecture.")
+    memory = SemanticMemory()
+    memory.add_document_path(str(tmp_path / "architecture.txt"))
+    assert len(memory.documents) == 1
+
+    # a document with the same name is neither added nor embedded again
+    mock_embedding.embedded_texts.clear()
+    memory.add_document_path(str(tmp_path / "architecture.txt"))
+    assert len(memory.documents) == 1, "A document that was already added should be skipped."
+    assert mock_embedding.embedded_texts == [], "A document that was already added should not be embedded again."
+    assert len(memory.index.docstore.docs) == 1, "A document that was already added should not be indexed again."
+
+    # a new document is added and indexed
+    (tmp_path / "medicine.txt").write_text("Some notes about medicine.")
+    memory.add_document_path(str(tmp_path / "medicine.txt"))
+    assert memory.list_documents_names() == ["architecture.txt", "medicine.txt"]
+    assert len(memory.index.docstore.docs) == 2, "A new document should be indexed."
+
+    # documents with the same name added together (e.g., the pages of a file) are all kept
+    pages = [Document(text=f"Page {i} of the report.", metadata={"file_name": "report.pdf"}) for i in range(3)]
+    memory._add_documents(pages, lambda doc: doc.metadata["file_name"])
+    assert len(memory.documents) == 5, "All the pages of a new file should be added."
+    assert "Page 0" in memory.retrieve_document_content_by_name("report.pdf"), "The file's name should refer to its first page."
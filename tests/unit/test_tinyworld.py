@@ -1,11 +1,9 @@
 import pytest
+import json
+import copy
 import logging
 logger = logging.getLogger("tinytroupe")
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
 
 from tinytroupe.examples import create_lisa_the_data_scientist, create_oscar_the_architect, create_marcos_the_physician
 from tinytroupe.environment import TinyWorld
@@ -76,3 +74,20 @@ def test_decode_complete_state(setup, focus_group_world):
     assert len(world_2.agents) == n_agents_1, "The world should have the same number of agents."
 
 
+
+def test_run_with_parallel_agents_actions(setup, focus_group_prototypes, mock_llm):
+    mock_llm.content = json.dumps({"action": {"type": "DONE", "content": "", "target": ""},
+                                   "cognitive_state": {"goals": "None", "attention": "None", "emotions": "Calm"}})
+
+    agents = [copy.deepcopy(prototype) for prototype in focus_group_prototypes]
+    for agent in agents:
+        TinyPerson.add_agent(agent)
+    world = TinyWorld("Parallel focus group", agents, parallelize_agents_actions=True)
+
+    agents_actions_over_time = world.run(1, return_actions=True)
+
+    # every agent must have acted once, and the results must be reported under the right names
+    assert len(mock_llm.sent_messages) == len(agents), "Each agent should have called the model exactly once."
+    for agent in agents:
+        actions = agents_actions_over_time[0][agent.name]
+        assert terminates_with_action_type(actions, "DONE"), f"{agent.name} should have terminated with a DONE action."
@@ -1,13 +1,10 @@
 import pytest
+import math
 from unittest.mock import MagicMock
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
-
 
 from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error
+import tinytroupe.utils as utils
 from testing_utils import *
 
 def test_extract_json():
@@ -37,6 +34,34 @@ def test_extract_json():
     assert result == {}
 
 
+def test_compact_json_dumps():
+    obj = {"b": 1, "a": ["Olá", None, True], 1: "non-string key"}
+
+    # no whitespace, and non-ASCII characters are kept as they are
+    assert utils.compact_json_dumps(obj) == '{"b":1,"a":["Olá",null,true],"1":"non-string key"}'
+
+    # sorting the keys makes the result independent of the insertion order
+    assert utils.compact_json_dumps({"b": 1, "a": 2}, sort_keys=True) == utils.compact_json_dumps({"a": 2, "b": 1}, sort_keys=True)
+
+def test_json_serializable_file_roundtrip(tmp_path):
+    class _Serializable(utils.JsonSerializableRegistry):
+        def __init__(self):
+            self.values = {"score": float("nan"), "limit": float("inf"), "name": "Olá"}
+
+    file_path = str(tmp_path / "serializable.json")
+    _Serializable().to_json(file_path=file_path)
+
+    # written as json.dump(..., indent=4) does, non-finite floats included
+    with open(file_path) as f:
+        contents = f.read()
+    assert '\n    "values": {\n        "score": NaN,' in contents
+    assert '"limit": Infinity' in contents
+
+    loaded = _Serializable.from_json(file_path)
+    assert math.isnan(loaded.values["score"])
+    assert loaded.values["limit"] == float("inf")
+    assert loaded.values["name"] == "Olá"
+
 def test_name_or_empty():
     class MockEntity:
         def __init__(self, name):
@@ -85,6 +110,28 @@ def test_repeat_on_error():
         decorated_function()
     assert dummy_function.call_count == 1
 
+def test_repeat_on_error_with_backoff(monkeypatch):
+    class DummyException(Exception):
+        pass
+
+    # record the waits instead of actually sleeping
+    waits = []
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: waits.append(seconds))
+
+    retries = 5
+    dummy_function = MagicMock(side_effect=DummyException())
+    with pytest.raises(DummyException):
+        @repeat_on_error(retries=retries, exceptions=[DummyException], initial_wait=1.0, max_wait=3.0)
+        def decorated_function():
+            dummy_function()
+        decorated_function()
+    assert dummy_function.call_count == retries
+
+    # there is no wait after the last attempt, and the waits never exceed their bounds
+    assert len(waits) == retries - 1
+    for i, wait in enumerate(waits):
+        assert 0 <= wait <= min(3.0, 1.0 * (2 ** i))
+
 
 # TODO
 #def test_json_serializer():
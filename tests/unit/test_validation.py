@@ -1,11 +1,6 @@
 import pytest
 import os
 
-import sys
-sys.path.append('../../tinytroupe/')
-sys.path.append('../../')
-sys.path.append('..')
-
 
 from tinytroupe.examples import create_oscar_the_architect
 from tinytroupe.control import Simulation
@@ -26,7 +21,6 @@ def test_validate_person(setup):
     Is facing a lot of pressure from the board of directors to fight off the competition from the fintechs.    
     """
     banker_factory = TinyPersonFactory(banker_spec)
-    banker = banker_factory.generate_person()
     banker_expectations =\
     """
     He/she is:
@@ -46,12 +40,6 @@ def test_validate_person(setup):
     - Deep knowledge of finance, economics and financial technology
     - Is a bit of a snob
     """
-    banker_score, banker_justification = TinyPersonValidator.validate_person(banker, expectations=banker_expectations, include_agent_spec=False, max_content_length=None)
-    print("Banker score: ", banker_score)
-    print("Banker justification: ", banker_justification)
-
-    assert banker_score > 0.5, f"Validation score is too low: {banker_score:.2f}"
-
 
     ##########################
     # Busy Knowledge Worker   
@@ -61,7 +49,6 @@ def test_validate_person(setup):
     A poor buddhist monk living alone and isolated in a remote montain.
     """
     monk_spec_factory = TinyPersonFactory(monk_spec)
-    monk = monk_spec_factory.generate_person()
     monk_expectations =\
     """
     Some characteristics of this person:
@@ -72,7 +59,20 @@ def test_validate_person(setup):
     - Honesty is a core value    
     """
 
-    monk_score, monk_justification = TinyPersonValidator.validate_person(monk, expectations=monk_expectations, include_agent_spec=False, max_content_length=None)
+    # the two people are independent, so they can be generated and validated concurrently
+    banker, monk = run_concurrently(lambda factory: factory.generate_person(), [banker_factory, monk_spec_factory])
+
+    (banker_score, banker_justification), (monk_score, monk_justification) = \
+        run_concurrently(lambda person_and_expectations: TinyPersonValidator.validate_person(person_and_expectations[0], 
+                                                                                            expectations=person_and_expectations[1], 
+                                                                                            include_agent_spec=False, max_content_length=None),
+                         [(banker, banker_expectations), (monk, monk_expectations)])
+
+    print("Banker score: ", banker_score)
+    print("Banker justification: ", banker_justification)
+
+    assert banker_score > 0.5, f"Validation score is too low: {banker_score:.2f}"
+
     print("Monk score: ", monk_score)
     print("Monk justification: ", monk_justification)
           
@@ -80,8 +80,37 @@ def test_validate_person(setup):
     assert monk_score > 0.5, f"Validation score is too low: {monk_score:.2f}"
 
     # Now, let's check the score for the busy knowledge worker with the wrong expectations! It has to be low!
+    # (This one must wait for the previous validation, since the monk is interviewed again.)
     wrong_expectations_score, wrong_expectations_justification = TinyPersonValidator.validate_person(monk, expectations=banker_expectations, include_agent_spec=False, max_content_length=None)
 
     assert wrong_expectations_score < 0.5, f"Validation score is too high: {wrong_expectations_score:.2f}"
     print("Wrong expectations score: ", wrong_expectations_score)
-    print("Wrong expectations justification: ", wrong_expectations_justification)
\ No newline at end of file
+    print("Wrong expectations justification: ", wrong_expectations_justification)
+
+
+def test_validation_cache_key(setup):
+    oscar = create_oscar_the_architect()
+
+    expectations = "He is an architect.\n    Likes modernist design."
+    key = TinyPersonValidator._validation_cache_key(oscar, expectations, include_agent_spec=False)
+
+    # whitespace and capitalization differences in the expectations do not matter
+    assert key == TinyPersonValidator._validation_cache_key(oscar, "he is an architect. likes   modernist design.", include_agent_spec=False), "Normalized expectations should lead to the same key."
+
+    # nor do changes to the person's current state
+    oscar.change_context(["office", "busy"])
+    assert key == TinyPersonValidator._validation_cache_key(oscar, expectations, include_agent_spec=False), "The current state of the person should not change the key."
+
+    # but different expectations or specifications do
+    assert key != TinyPersonValidator._validation_cache_key(oscar, "He is a physician.", include_agent_spec=False), "Different expectations should lead to a different key."
+    
+    oscar.define("age", 70)
+    assert key != TinyPersonValidator._validation_cache_key(oscar, expectations, include_agent_spec=False), "A different specification should lead to a different key."
+
+def test_parse_validation_result():
+    result = TinyPersonValidator._parse_validation_result('Done.\n```json\n{"score": 0.8, "justification": "Matches the expectations."}\n```')
+    assert result.score == 0.8, "The score should be read from the JSON output."
+    assert result.justification == "Matches the expectations.", "The justification should be read from the JSON output."
+
+    assert TinyPersonValidator._parse_validation_result('```json\n{"score": 0.8}\n```') is None, "A result without justification should not be accepted."
+    assert TinyPersonValidator._parse_validation_result("No JSON here.") is None, "A result without JSON should not be accepted."
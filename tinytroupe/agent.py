@@ -16,6 +16,7 @@ to understand how agents interact with the environment and other agents.
 import os
 import csv
 import json
+import hashlib
 import ast
 import textwrap  # to dedent strings
 import datetime  # to get current datetime
@@ -27,8 +28,13 @@ import tinytroupe.utils as utils
 from tinytroupe.utils import post_init
 from tinytroupe.control import transactional
 from tinytroupe.control import current_simulation
+import rich
 from rich import print
 import copy
+import collections
+import functools
+import contextlib
+import concurrent.futures
 from tinytroupe.utils import JsonSerializableRegistry
 
 from typing import Any, Callable, TypeVar, Union
@@ -44,34 +50,119 @@ config = utils.read_config_file()
 
 default = {}
 default["embedding_model"] = config["OpenAI"].get("EMBEDDING_MODEL", "text-embedding-3-small")
+default["embedding_batch_size"] = config["OpenAI"].getint("EMBEDDING_BATCH_SIZE", 256)
 default["max_content_display_length"] = config["OpenAI"].getint("MAX_CONTENT_DISPLAY_LENGTH", 1024)
 
+@functools.lru_cache(maxsize=1024)
+def _maybe_dedent(text:str) -> str:
+    """
+    Same as textwrap.dedent, but without scanning texts that have no line starting with spaces or tabs, 
+    which is the case for most definitions. Cached, since specs often repeat the same texts across agents.
+    """
+    if text.startswith((" ", "\t")) or "\n " in text or "\n\t" in text:
+        return textwrap.dedent(text)
+    else:
+        return text
 
 ## LLaMa-Index configs ########################################################
-#from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader, Document
-from llama_index.readers.web import SimpleWebPageReader
+from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader, Document, StorageContext
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.storage.kvstore import SimpleKVStore
+from llama_index.core.vector_stores.types import VectorStoreQueryMode, VectorStoreQueryResult
+from pydantic import PrivateAttr
+import numpy as np
+
+@functools.lru_cache(maxsize=1)
+def _setup_embedding_model():
+    """
+    Creates the embedding model used to index documents in semantic memory, and makes it the llama-index default.
+    This only happens when documents are first indexed, so that agents that never do so neither pay for it nor
+    require an embedding service to be configured.
+    """
 
+    # this will be cached locally by llama-index, in a OS-dependend location
+    #
+    ##from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    ##embed_model = HuggingFaceEmbedding(
+    ##    model_name="BAAI/bge-small-en-v1.5"
+    ##)
 
-# this will be cached locally by llama-index, in a OS-dependend location
+    # for OpenAI embeddings
+    #
+    ##from llama_index.embeddings.openai import OpenAIEmbedding
+    ##embed_model = OpenAIEmbedding(model=default["embedding_model"], embed_batch_size=default["embedding_batch_size"],
+    ##                              embeddings_cache=SimpleKVStore())
+
+    # for ollama embeddings
+    from llama_index.embeddings.ollama import OllamaEmbedding
 
-##Settings.embed_model = HuggingFaceEmbedding(
-##    model_name="BAAI/bge-small-en-v1.5"
-##)
+    embed_model = OllamaEmbedding(
+        model_name=config["Ollama"].get("EMBEDDING_MODEL"), #"bge-m3:latest",
+        base_url=config["Ollama"].get("EMBEDDING_URL"),
+        ollama_additional_kwargs={"mirostat": 0},
+        embed_batch_size=default["embedding_batch_size"],
+        # embeddings are cached by text for the whole process, so that the same contents indexed by several
+        # agents (e.g., agents grounded on the same folder) or re-indexed later are only embedded once
+        embeddings_cache=SimpleKVStore(),
+    )
 
-# for ollama embeddings
-from llama_index.embeddings.ollama import OllamaEmbedding
+    Settings.embed_model = embed_model
+    return embed_model
 
-ollama_embedding = OllamaEmbedding(
-    model_name=config["Ollama"].get("EMBEDDING_MODEL"), #"bge-m3:latest",
-    base_url=config["Ollama"].get("EMBEDDING_URL"),
-    ollama_additional_kwargs={"mirostat": 0},
-)
 
+class _MatrixVectorStore(SimpleVectorStore):
+    """
+    The default in-memory vector store, but answering plain similarity queries with a single matrix product 
+    over all embeddings, instead of computing the similarity to each embedding separately in Python. 
+    The embeddings matrix is built on the first query and kept until the stored nodes change.
+    """
+
+    _matrix: Any = PrivateAttr(default=None)
+    _matrix_node_ids: list = PrivateAttr(default=None)
+
+    def add(self, nodes, **add_kwargs):
+        self._matrix = None
+        return super().add(nodes, **add_kwargs)
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        self._matrix = None
+        return super().delete(ref_doc_id, **delete_kwargs)
+
+    def delete_nodes(self, node_ids=None, filters=None, **delete_kwargs):
+        self._matrix = None
+        return super().delete_nodes(node_ids, filters, **delete_kwargs)
+
+    def clear(self):
+        self._matrix = None
+        return super().clear()
+
+    def query(self, query, **kwargs):
+        # anything other than a plain similarity query over all nodes is left to the default implementation
+        if query.mode != VectorStoreQueryMode.DEFAULT or query.filters is not None or query.node_ids is not None \
+           or len(self.data.embedding_dict) == 0:
+            return super().query(query, **kwargs)
+
+        if self._matrix is None:
+            self._matrix_node_ids = list(self.data.embedding_dict.keys())
+            matrix = np.array(list(self.data.embedding_dict.values()), dtype=np.float32)
+            
+            # normalized once, so that the cosine similarity becomes a plain dot product. Zero embeddings are left 
+            # as they are, so that their similarity to anything is 0 rather than NaN.
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self._matrix = matrix / np.where(norms == 0, 1, norms)
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query_embedding)
+        similarities = self._matrix @ (query_embedding / (query_norm if query_norm != 0 else 1))
+
+        # only the top k are sorted
+        top_k = min(query.similarity_top_k or len(similarities), len(similarities))
+        top_indices = np.argpartition(-similarities, top_k - 1)[:top_k]
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
+
+        return VectorStoreQueryResult(similarities=[float(similarities[i]) for i in top_indices],
+                                      ids=[self._matrix_node_ids[i] for i in top_indices])
 
-llmaindex_openai_embed_model = OpenAIEmbedding(model=default["embedding_model"], embed_batch_size=10)
-Settings.embed_model = ollama_embedding
 ###############################################################################
 
 
@@ -92,6 +183,10 @@ class TinyPerson(JsonSerializableRegistry):
 
     PP_TEXT_WIDTH = 100
 
+    # The maximum number of displayed communications kept in the buffer until they are popped. Older ones are dropped,
+    # so that agents displaying outside of a simulation (which would otherwise pop them regularly) do not grow without bound.
+    MAX_DISPLAYED_COMMUNICATIONS = 10000
+
     serializable_attributes = ["name", "episodic_memory", "semantic_memory", "_mental_faculties", "_configuration"]
 
     # A dict of all agents instantiated so far.
@@ -161,9 +256,19 @@ class TinyPerson(JsonSerializableRegistry):
         # This can change over time, as agents move around the world.
         self._accessible_agents = []
 
+        # the names of the agents above, for fast membership checks (worlds make every agent accessible to every other one).
+        # Names are used rather than ids, since they are unique and remain valid when agents are copied.
+        self._accessible_agent_names = set()
+
+        # the JSON serializations of the contents last sent to the model, by id of the content object
+        self._serialized_contents = {}
+
+        # the pretty renderings of the messages last shown by pretty_current_interactions, by id of the message
+        self._pretty_interactions_cache = {}
+
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
-        self._displayed_communications_buffer = []
+        self._displayed_communications_buffer = collections.deque(maxlen=TinyPerson.MAX_DISPLAYED_COMMUNICATIONS)
 
         if not hasattr(self, 'episodic_memory'):
             # This default value MUST NOT be in the method signature, otherwise it will be shared across all instances.
@@ -211,6 +316,25 @@ class TinyPerson(JsonSerializableRegistry):
         )
         self._init_system_message = None  # initialized later
 
+        # nesting depth of batched_updates() blocks, and whether a prompt reset was deferred by them
+        self._batched_updates_depth = 0
+        self._prompt_reset_pending = False
+
+        # the variables the system prompt was last rendered from, so that an unchanged prompt is not rendered again
+        self._system_prompt_variables_key = None
+        self._system_prompt = None
+
+        # the prompts of the mental faculties, along with the ids of the faculties they were built from
+        self._mental_faculties_prompts_cache = None
+
+        # the environment's datetime last formatted, along with its ISO and pretty formats, since time only
+        # advances once per world step while it is formatted on every stored episode and cognitive state update
+        self._formatted_datetime_cache = None
+
+        # identifies the rendered system prompt, so that LLM backends can reuse the work done for it across requests 
+        # (and across agents with the same prompt)
+        self._system_prompt_cache_key = None
+
 
         ############################################################
         # Special mechanisms used during deserialization
@@ -223,15 +347,11 @@ class TinyPerson(JsonSerializableRegistry):
         # If auto-rename, use the given name plus some new number ...
         if kwargs.get("auto_rename") is True:
             new_name = self.name # start with the current name
-            rename_succeeded = False
-            while not rename_succeeded:
-                try:
-                    self._rename(new_name)
-                    TinyPerson.add_agent(self)
-                    rename_succeeded = True                
-                except ValueError:
-                    new_id = utils.fresh_id()
-                    new_name = f"{self.name}_{new_id}"
+            while TinyPerson.has_agent(new_name):
+                new_name = f"{self.name}_{utils.fresh_id()}"
+
+            self._rename(new_name)
+            TinyPerson.add_agent(self)
         
         # ... otherwise, just register the agent
         else:
@@ -254,28 +374,46 @@ class TinyPerson(JsonSerializableRegistry):
 
 
     def generate_agent_system_prompt(self):
-        with open(self._prompt_template_path, "r") as f:
-            agent_prompt_template = f.read()
-
-        # let's operate on top of a copy of the configuration, because we'll need to add more variables, etc.
-        template_variables = self._configuration.copy()    
-
-        # Prepare additional action definitions and constraints
-        actions_definitions_prompt = ""
-        actions_constraints_prompt = ""
-        for faculty in self._mental_faculties:
-            actions_definitions_prompt += f"{faculty.actions_definitions_prompt()}\n"
-            actions_constraints_prompt += f"{faculty.actions_constraints_prompt()}\n"
-        
-        # Make the additional prompt pieces available to the template. 
-        # Identation here is to align with the text structure in the template.
-        template_variables['actions_definitions_prompt'] = textwrap.indent(actions_definitions_prompt.strip(), "  ")
-        template_variables['actions_constraints_prompt'] = textwrap.indent(actions_constraints_prompt.strip(), "  ")
+        # the template itself never changes, so it is only read and parsed once
+        agent_prompt_template = utils.tokenized_template(self._prompt_template_path)
+
+        # the additional variables are put on top of the configuration, which itself is not copied nor changed
+        template_variables = collections.ChainMap({}, self._configuration)
+
+        # Make the additional action definitions and constraints available to the template.
+        template_variables['actions_definitions_prompt'], template_variables['actions_constraints_prompt'] = \
+            self._mental_faculties_prompts()
 
         # RAI prompt components, if requested
         template_variables = utils.add_rai_template_variables_if_enabled(template_variables)
 
-        return chevron.render(agent_prompt_template, template_variables)
+        # the prompt is regenerated very often (e.g., before every action), but the variables it is rendered
+        # from change much less frequently, so the last rendering is reused while they stay the same
+        variables_key = utils.compact_json_dumps(template_variables.maps, sort_keys=True)
+        if variables_key != self._system_prompt_variables_key:
+            self._system_prompt = chevron.render(agent_prompt_template, template_variables)
+            self._system_prompt_variables_key = variables_key
+            self._system_prompt_cache_key = hashlib.sha256(self._system_prompt.encode("utf-8")).hexdigest()
+
+        return self._system_prompt
+
+    def _mental_faculties_prompts(self) -> tuple:
+        """
+        Returns the action definitions and constraints prompts of all mental faculties, ready to be used in the template. 
+        These are only built again when the faculties change, since a faculty's prompts are not expected to change 
+        once it is added to the agent.
+        """
+        faculties_ids = tuple(id(faculty) for faculty in self._mental_faculties)
+        if self._mental_faculties_prompts_cache is None or self._mental_faculties_prompts_cache[0] != faculties_ids:
+            actions_definitions_prompt = "".join(f"{faculty.actions_definitions_prompt()}\n" for faculty in self._mental_faculties)
+            actions_constraints_prompt = "".join(f"{faculty.actions_constraints_prompt()}\n" for faculty in self._mental_faculties)
+
+            # Identation here is to align with the text structure in the template.
+            self._mental_faculties_prompts_cache = (faculties_ids, 
+                                                    textwrap.indent(actions_definitions_prompt.strip(), "  "),
+                                                    textwrap.indent(actions_constraints_prompt.strip(), "  "))
+        
+        return self._mental_faculties_prompts_cache[1:]
 
     def reset_prompt(self):
 
@@ -284,14 +422,13 @@ class TinyPerson(JsonSerializableRegistry):
 
         # TODO actually, figure out another way to update agent state without "changing history"
 
-        # reset system message
+        # reset system message, followed by the actual interaction messages to use for prompting
+        # (built in one go, since the recent memories are already a fresh list)
         self.current_messages = [
-            {"role": "system", "content": self._init_system_message}
+            {"role": "system", "content": self._init_system_message},
+            *self.retrieve_recent_memories()
         ]
 
-        # sets up the actual interaction messages to use for prompting
-        self.current_messages += self.retrieve_recent_memories()
-
         # add a final user message, which is neither stimuli or action, to instigate the agent to act properly
         self.current_messages.append({"role": "user", 
                                       "content": "Now you **must** generate a sequence of actions following your interaction directives, " +\
@@ -314,9 +451,48 @@ class TinyPerson(JsonSerializableRegistry):
         Otherwise, the value is added to the specified group.
         """
 
+        self._add_definition(key, value, group)
+
+        # must reset prompt after adding to configuration
+        self._reset_prompt_unless_batched()
+
+    @transactional
+    def define_several(self, group, records):
+        """
+        Define several values to the TinyPerson's configuration, all belonging to the same group.
+        """
+        try:
+            for record in records:
+                self._add_definition(key=None, value=record, group=group)
+        finally:
+            # the prompt only needs to be reset once, after all the records have been added
+            self._reset_prompt_unless_batched()
+
+    @contextlib.contextmanager
+    def batched_updates(self):
+        """
+        Defers the prompt resets caused by definitions (e.g., define, define_several) made within the block
+        until its end, so that the prompt is rendered only once for all of them. Blocks can be nested.
+        """
+        self._batched_updates_depth += 1
+        try:
+            yield self
+        finally:
+            self._batched_updates_depth -= 1
+            if self._batched_updates_depth == 0 and self._prompt_reset_pending:
+                self._prompt_reset_pending = False
+                self.reset_prompt()
+
+    def _reset_prompt_unless_batched(self):
+        if self._batched_updates_depth > 0:
+            self._prompt_reset_pending = True
+        else:
+            self.reset_prompt()
+
+    def _add_definition(self, key, value, group=None):
         # dedent value if it is a string
         if isinstance(value, str):
-            value = textwrap.dedent(value)
+            value = _maybe_dedent(value)
 
         if group is None:
             # logger.debug(f"[{self.name}] Defining {key}={value} in the person.")
@@ -328,16 +504,6 @@ class TinyPerson(JsonSerializableRegistry):
             else:
                 # logger.debug(f"[{self.name}] Adding definition to {group} += [ {value} ] in the person.")
                 self._configuration[group].append(value)
-
-        # must reset prompt after adding to configuration
-        self.reset_prompt()
-
-    def define_several(self, group, records):
-        """
-        Define several values to the TinyPerson's configuration, all belonging to the same group.
-        """
-        for record in records:
-            self.define(key=None, value=record, group=group)
     
     @transactional
     def define_relationships(self, relationships, replace=True):
@@ -413,6 +579,7 @@ class TinyPerson(JsonSerializableRegistry):
         # check if the faculty is already there or not
         if faculty not in self._mental_faculties:
             self._mental_faculties.append(faculty)
+            self._mental_faculties_prompts_cache = None
         else:
             raise Exception(f"The mental faculty {faculty} is already present in the agent.")
         
@@ -594,11 +761,7 @@ class TinyPerson(JsonSerializableRegistry):
         """
 
         return self._observe(
-            stimulus={
-                "type": "CONVERSATION",
-                "content": speech,
-                "source": name_or_empty(source),
-            },
+            stimulus=self._make_stimulus("CONVERSATION", speech, source),
             max_content_length=max_content_length,
         )
 
@@ -616,11 +779,7 @@ class TinyPerson(JsonSerializableRegistry):
             source (AgentOrWorld, optional): The source of the social stimulus. Defaults to None.
         """
         return self._observe(
-            stimulus={
-                "type": "SOCIAL",
-                "content": social_description,
-                "source": name_or_empty(source),
-            },
+            stimulus=self._make_stimulus("SOCIAL", social_description, source),
             max_content_length=max_content_length,
         )
 
@@ -638,11 +797,7 @@ class TinyPerson(JsonSerializableRegistry):
             source (AgentOrWorld, optional): The source of the visual stimulus. Defaults to None.
         """
         return self._observe(
-            stimulus={
-                "type": "VISUAL",
-                "content": visual_description,
-                "source": name_or_empty(source),
-            },
+            stimulus=self._make_stimulus("VISUAL", visual_description, source),
             max_content_length=max_content_length,
         )
 
@@ -652,11 +807,7 @@ class TinyPerson(JsonSerializableRegistry):
 
         """
         return self._observe(
-            stimulus={
-                "type": "THOUGHT",
-                "content": thought,
-                "source": name_or_empty(self),
-            },
+            stimulus=self._make_stimulus("THOUGHT", thought, self),
             max_content_length=max_content_length,
         )
 
@@ -667,21 +818,24 @@ class TinyPerson(JsonSerializableRegistry):
         Internalizes a goal and updates its internal cognitive state.
         """
         return self._observe(
-            stimulus={
-                "type": "INTERNAL_GOAL_FORMULATION",
-                "content": goal,
-                "source": name_or_empty(self),
-            },
+            stimulus=self._make_stimulus("INTERNAL_GOAL_FORMULATION", goal, self),
             max_content_length=max_content_length,
         )
 
+    @staticmethod
+    def _make_stimulus(stimulus_type:str, content, source:AgentOrWorld) -> dict:
+        """
+        Builds a single stimulus, as stored in memory and shown to the model.
+        """
+        return {"type": stimulus_type, "content": content, "source": name_or_empty(source)}
+
     @transactional
     def _observe(self, stimulus, max_content_length=default["max_content_display_length"]):
-        stimuli = [stimulus]
-
-        content = {"stimuli": stimuli}
+        # the memory (and the model) expect a list of stimuli, even though only one is observed at a time
+        content = {"stimuli": [stimulus]}
 
-        logger.debug(f"[{self.name}] Observing stimuli: {content}")
+        # lazy formatting, since observing is on the hot path of simulations and debug logging is usually off
+        logger.debug("[%s] Observing stimuli: %s", self.name, content)
 
         # whatever comes from the outside will be interpreted as coming from 'user', simply because
         # this is the counterpart of 'assistant'
@@ -793,15 +947,16 @@ class TinyPerson(JsonSerializableRegistry):
         self.change_context(context)
 
     @transactional
-    def change_context(self, context: list):
+    def change_context(self, context: Union[list, str]):
         """
-        Changes the context and updates its internal cognitive state.
+        Changes the context and updates its internal cognitive state. The context can be a list of items, 
+        or a single description of it.
         """
-        self._configuration["current_context"] = {
-            "description": item for item in context
-        }
+        if isinstance(context, str):
+            context = [context]
 
-        self._update_cognitive_state(context=context)
+        # the template expects each element of the context to have a description
+        self._update_cognitive_state(context=[{"description": item} for item in context])
 
     @transactional
     def make_agent_accessible(
@@ -812,8 +967,9 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Makes an agent accessible to this agent.
         """
-        if agent not in self._accessible_agents:
+        if agent.name not in self._accessible_agent_names:
             self._accessible_agents.append(agent)
+            self._accessible_agent_names.add(agent.name)
             self._configuration["currently_accessible_agents"].append(
                 {"name": agent.name, "relation_description": relation_description}
             )
@@ -827,8 +983,9 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Makes an agent inaccessible to this agent.
         """
-        if agent in self._accessible_agents:
-            self._accessible_agents.remove(agent)
+        if agent.name in self._accessible_agent_names:
+            self._accessible_agents = [a for a in self._accessible_agents if a.name != agent.name]
+            self._accessible_agent_names.discard(agent.name)
         else:
             logger.warning(
                 f"[{self.name}] Agent {agent.name} is already inaccessible to {self.name}."
@@ -840,6 +997,7 @@ class TinyPerson(JsonSerializableRegistry):
         Makes all agents inaccessible to this agent.
         """
         self._accessible_agents = []
+        self._accessible_agent_names = set()
         self._configuration["currently_accessible_agents"] = []
 
     @transactional
@@ -849,15 +1007,13 @@ class TinyPerson(JsonSerializableRegistry):
         # ensure we have the latest prompt (initial system message + selected messages from memory)
         self.reset_prompt()
 
-        messages = [
-            {"role": msg["role"], "content": json.dumps(msg["content"])}
-            for msg in self.current_messages
-        ]
+        messages = self._current_messages_for_model()
 
         logger.debug(f"[{self.name}] Sending messages to OpenAI API")
         logger.debug(f"[{self.name}] Last interaction: {messages[-1]}")
 
-        next_message = openai_utils.client().send_message(messages, response_format=CognitiveActionModel.model_json_schema())
+        next_message = openai_utils.client().send_message(messages, response_format=CognitiveActionModel.model_json_schema(),
+                                                          prompt_cache_key=self._system_prompt_cache_key)
 
         logger.debug(f"[{self.name}] Received message: {next_message}")
 
@@ -870,10 +1026,7 @@ class TinyPerson(JsonSerializableRegistry):
         # ensure we have the latest prompt (initial system message + selected messages from memory)
         self.reset_prompt()
 
-        messages = [
-            {"role": msg["role"], "content": json.dumps(msg["content"])}
-            for msg in self.current_messages
-        ]
+        messages = self._current_messages_for_model()
 
         logger.debug(f"[{self.name}] Sending messages to OpenAI API")
         logger.debug(f"[{self.name}] Last interaction: {messages[-1]}")
@@ -881,7 +1034,8 @@ class TinyPerson(JsonSerializableRegistry):
             "type":"array",
             "items":CognitiveActionModel.model_json_schema()
         }
-        next_messages = openai_utils.client().send_message(messages, response_format=schema, is_quick=is_quick)
+        next_messages = openai_utils.client().send_message(messages, response_format=schema, is_quick=is_quick,
+                                                           prompt_cache_key=self._system_prompt_cache_key)
 
         logger.debug(f"[{self.name}] Received message: {next_messages}")
 
@@ -889,6 +1043,31 @@ class TinyPerson(JsonSerializableRegistry):
         all_msgs = json.loads(next_messages["content"])
         for next_message in all_msgs:
             yield next_msg_role, next_message #utils.extract_json(next_message)
+
+    def _current_messages_for_model(self) -> list:
+        """
+        Returns the current messages in the form they are sent to the model, with their contents serialized as JSON.
+        Most of the messages come unchanged from memory turn after turn, so their serialized contents are reused.
+        """
+        previously_serialized = self._serialized_contents
+        self._serialized_contents = {}
+
+        messages = []
+        for msg in self.current_messages:
+            content = msg["content"]
+
+            # the content object itself is kept along with its serialization, so its id cannot be reused by another object
+            cached = previously_serialized.get(id(content))
+            if cached is not None and cached[0] is content:
+                serialized_content = cached[1]
+            else:
+                serialized_content = utils.compact_json_dumps(content)
+
+            self._serialized_contents[id(content)] = (content, serialized_content)
+            messages.append({"role": msg["role"], "content": serialized_content})
+
+        return messages
+
     ###########################################################
     # Internal cognitive state changes
     ###########################################################
@@ -902,7 +1081,7 @@ class TinyPerson(JsonSerializableRegistry):
 
         # Update current datetime. The passage of time is controlled by the environment, if any.
         if self.environment is not None and self.environment.current_datetime is not None:
-            self._configuration["current_datetime"] = utils.pretty_datetime(self.environment.current_datetime)
+            self._configuration["current_datetime"] = self._formatted_datetime(self.environment.current_datetime)[1]
 
         # update current goals
         if goals is not None:
@@ -1036,17 +1215,20 @@ class TinyPerson(JsonSerializableRegistry):
         Pushes the latest communications to the agent's buffer.
         """
         self._displayed_communications_buffer.append(communication)
+
         print(communication["rendering"])
 
     def pop_and_display_latest_communications(self):
         """
         Pops the latest communications and displays them.
         """
-        communications = self._displayed_communications_buffer
-        self._displayed_communications_buffer = []
+        communications = list(self._displayed_communications_buffer)
+        self._displayed_communications_buffer.clear()
 
-        for communication in communications:
-            print(communication)
+        # the console's buffer collects all of them, so that they are written out at once
+        with rich.get_console():
+            for communication in communications:
+                print(communication)
 
         return communications
 
@@ -1054,7 +1236,7 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Cleans the communications buffer.
         """
-        self._displayed_communications_buffer = []
+        self._displayed_communications_buffer.clear()
 
     @transactional
     def pop_latest_actions(self) -> list:
@@ -1080,15 +1262,16 @@ class TinyPerson(JsonSerializableRegistry):
             only_last_action (bool, optional): Whether to only return the contents of the last action. Defaults to False.
         """
         actions = self.pop_latest_actions()
-        # Filter the actions by type
-        actions = [action for action in actions if action["type"] == action_type]
 
-        # If interested only in the last action, return the latest one
+        # If interested only in the last action, look for it from the end, without filtering all the others
         if only_last_action:
-            return actions[-1].get("content", "")
+            for action in reversed(actions):
+                if action["type"] == action_type:
+                    return action.get("content", "")
+            return ""
 
-        # Otherwise, return all contents from the filtered actions
-        return "\n".join([action.get("content", "") for action in actions])
+        # Otherwise, return all contents from the actions of that type
+        return "\n".join(action.get("content", "") for action in actions if action["type"] == action_type)
 
     #############################################################################################
     # Formatting conveniences
@@ -1159,52 +1342,50 @@ class TinyPerson(JsonSerializableRegistry):
       """
       Returns a pretty, readable, string with the current messages.
       """
+      # messages in memory do not change once stored, so the renderings of previous calls are reused
+      # (this is typically called again and again as the simulation goes, over a mostly unchanged history)
+      rendering_parameters = (self.name, simplified, max_content_length)
+      previous_renderings = self._pretty_interactions_cache
+      self._pretty_interactions_cache = {}
+
       lines = []
       for message in self.episodic_memory.retrieve(first_n=first_n, last_n=last_n, include_omission_info=include_omission_info):
         try:
-            if not (skip_system and message['role'] == 'system'):
-                msg_simplified_type = ""
-                msg_simplified_content = ""
-                msg_simplified_actor = ""
-
-                lines.append(self._pretty_timestamp(message['role'], message['simulation_timestamp']))
-
-                if message["role"] == "system":
-                    msg_simplified_actor = "SYSTEM"
-                    msg_simplified_type = message["role"]
-                    msg_simplified_content = message["content"]
-
-                    lines.append(
-                        f"[dim] {msg_simplified_type}: {msg_simplified_content}[/]"
-                    )
-
-                elif message["role"] == "user":
-                    lines.append(
-                        self._pretty_stimuli(
-                            role=message["role"],
-                            content=message["content"],
-                            simplified=simplified,
-                            max_content_length=max_content_length,
-                        )
-                    )
-
-                elif message["role"] == "assistant":
-                    lines.append(
-                        self._pretty_action(
-                            role=message["role"],
-                            content=message["content"],
-                            simplified=simplified,
-                            max_content_length=max_content_length,
-                        )
-                    )
+            role = message["role"]
+            if not (skip_system and role == "system"):
+                # the message itself is kept along with its rendering, so its id cannot be reused by another object
+                cached = previous_renderings.get(id(message))
+                if cached is not None and cached[0] is message and cached[1] == rendering_parameters:
+                    timestamp_line, interaction_rendering = cached[2]
+                    lines.append(timestamp_line)
+                    lines.append(interaction_rendering)
                 else:
-                    lines.append(f"{message['role']}: {message['content']}")
-        except:
-            # print(f"ERROR: {message}")
+                    timestamp_line = self._pretty_timestamp(role, message["simulation_timestamp"])
+                    lines.append(timestamp_line)
+                    interaction_rendering = self._pretty_interaction(role, message["content"], simplified, max_content_length)
+                    lines.append(interaction_rendering)
+
+                self._pretty_interactions_cache[id(message)] = (message, rendering_parameters, (timestamp_line, interaction_rendering))
+
+        # malformed messages (e.g., the omission notice, whose content is not an action) are skipped
+        except (KeyError, TypeError, AttributeError):
             continue
 
       return "\n".join(lines)
 
+    def _pretty_interaction(self, role, content, simplified, max_content_length) -> str:
+        """
+        Pretty prints a message from memory, according to its role.
+        """
+        if role == "system":
+            return f"[dim] {role}: {content}[/]"
+        elif role == "user":
+            return self._pretty_stimuli(role=role, content=content, simplified=simplified, max_content_length=max_content_length)
+        elif role == "assistant":
+            return self._pretty_action(role=role, content=content, simplified=simplified, max_content_length=max_content_length)
+        else:
+            return f"{role}: {content}"
+
     def _pretty_stimuli(
         self,
         role,
@@ -1304,10 +1485,20 @@ class TinyPerson(JsonSerializableRegistry):
             datetime: The current datetime of the environment in ISO forat.
         """
         if self.environment is not None and self.environment.current_datetime is not None:
-            return self.environment.current_datetime.isoformat()
+            return self._formatted_datetime(self.environment.current_datetime)[0]
         else:
             return None
 
+    def _formatted_datetime(self, dt) -> tuple:
+        """
+        Returns the ISO and pretty formats of the specified datetime, reusing the last ones computed if it did not change.
+        """
+        # datetimes are immutable, so comparing by value is safe (unlike by id, which can be reused)
+        if self._formatted_datetime_cache is None or self._formatted_datetime_cache[0] != dt:
+            self._formatted_datetime_cache = (dt, dt.isoformat(), utils.pretty_datetime(dt))
+
+        return self._formatted_datetime_cache[1:]
+
     ###########################################################
     # IO
     ###########################################################
@@ -1367,13 +1558,25 @@ class TinyPerson(JsonSerializableRegistry):
         # delete the logger and other attributes that cannot be serialized
         del to_copy["environment"]
         del to_copy["_mental_faculties"]
+        del to_copy["_serialized_contents"]
+        del to_copy["_pretty_interactions_cache"]
+        del to_copy["_accessible_agent_names"]
+        del to_copy["_mental_faculties_prompts_cache"]
+        del to_copy["_formatted_datetime_cache"]
+        del to_copy["_system_prompt_variables_key"]
+        del to_copy["_system_prompt"]
 
         to_copy["_accessible_agents"] = [agent.name for agent in self._accessible_agents]
+        to_copy["_displayed_communications_buffer"] = list(self._displayed_communications_buffer)
         to_copy['episodic_memory'] = self.episodic_memory.to_json()
         to_copy['semantic_memory'] = self.semantic_memory.to_json()
         to_copy["_mental_faculties"] = [faculty.to_json() for faculty in self._mental_faculties]
 
-        state = copy.deepcopy(to_copy)
+        # the attributes encoded above are already fresh copies (to_json deep copies what it serializes), so only
+        # the remaining ones are deep copied. Memories are the bulk of the state, and would otherwise be copied twice.
+        freshly_encoded = {"_accessible_agents", "episodic_memory", "semantic_memory", "_mental_faculties"}
+        memo = {}
+        state = {key: value if key in freshly_encoded else copy.deepcopy(value, memo) for key, value in to_copy.items()}
 
         return state
 
@@ -1382,23 +1585,23 @@ class TinyPerson(JsonSerializableRegistry):
         Loads the complete state of the TinyPerson, including the current messages,
         and produces a new TinyPerson instance.
         """
-        state = copy.deepcopy(state)
-        
         self._accessible_agents = [TinyPerson.get_agent_by_name(name) for name in state["_accessible_agents"]]
+        # from the serialized names, since agents that are not registered (yet) are not found above
+        self._accessible_agent_names = set(state["_accessible_agents"])
+
+        # from_json already copies what it deserializes, so the memories (the bulk of the state) are not copied beforehand
         self.episodic_memory = EpisodicMemory.from_json(state['episodic_memory'])
         self.semantic_memory = SemanticMemory.from_json(state['semantic_memory'])
         
         for i, faculty in enumerate(self._mental_faculties):
             faculty = faculty.from_json(state['_mental_faculties'][i])
 
-        # delete fields already present in the state
-        del state["_accessible_agents"]
-        del state['episodic_memory']
-        del state['semantic_memory']
-        del state['_mental_faculties']
-
-        # restore other fields
-        self.__dict__.update(state)
+        # restore other fields, copied so that the given state is not shared with the agent
+        already_restored = {"_accessible_agents", "episodic_memory", "semantic_memory", "_mental_faculties"}
+        memo = {}
+        self.__dict__.update({key: copy.deepcopy(value, memo) for key, value in state.items() if key not in already_restored})
+        self._displayed_communications_buffer = collections.deque(self._displayed_communications_buffer, 
+                                                                  maxlen=TinyPerson.MAX_DISPLAYED_COMMUNICATIONS)
 
 
         return self
@@ -1454,10 +1657,7 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Gets an agent by name.
         """
-        if name in TinyPerson.all_agents:
-            return TinyPerson.all_agents[name]
-        else:
-            return None
+        return TinyPerson.all_agents.get(name, None)
     
     @staticmethod
     def all_agents_names():
@@ -1805,9 +2005,13 @@ class TinyToolUse(TinyMentalFaculty):
         self.tools = tools
     
     def process_action(self, agent, action: dict) -> bool:
+        # tools are only offered the actions they declare to handle, so that they do not even check (or, e.g., enforce
+        # ownership on) the many actions that have nothing to do with them
+        action_type = action["type"]
         for tool in self.tools:
-            if tool.process_action(agent, action):
-                return True
+            if tool.handled_action_types is None or action_type in tool.handled_action_types:
+                if tool.process_action(agent, action):
+                    return True
         
         return False
     
@@ -1943,15 +2147,18 @@ class EpisodicMemory(TinyMemory):
         
         """
 
-        omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
-
-        # use the other methods in the class to implement
         if first_n is not None and last_n is not None:
-            return self.retrieve_first(first_n) + omisssion_info + self.retrieve_last(last_n)
+            # sliced directly, so that a single omission info separates the first and last values
+            retrieved = self.memory[:first_n]
+            if include_omission_info:
+                retrieved.append(EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO)
+            if last_n > 0:
+                retrieved += self.memory[-last_n:]
+            return retrieved
         elif first_n is not None:
-            return self.retrieve_first(first_n)
+            return self.retrieve_first(first_n, include_omission_info=include_omission_info)
         elif last_n is not None:
-            return self.retrieve_last(last_n)
+            return self.retrieve_last(last_n, include_omission_info=include_omission_info)
         else:
             return self.retrieve_all()
 
@@ -1959,27 +2166,27 @@ class EpisodicMemory(TinyMemory):
         """
         Retrieves the n most recent values from memory.
         """
-        omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
-
         # compute fixed prefix
-        fixed_prefix = self.memory[: self.fixed_prefix_length] + omisssion_info
+        recent = self.memory[: self.fixed_prefix_length]
+        if include_omission_info:
+            recent.append(EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO)
 
         # how many lookback values remain?
         remaining_lookback = min(
-            len(self.memory) - len(fixed_prefix), self.lookback_length
+            len(self.memory) - len(recent), self.lookback_length
         )
 
-        # compute the remaining lookback values and return the concatenation
-        if remaining_lookback <= 0:
-            return fixed_prefix
-        else:
-            return fixed_prefix + self.memory[-remaining_lookback:]
+        # add the remaining lookback values in place, rather than concatenating into yet another list
+        if remaining_lookback > 0:
+            recent += self.memory[-remaining_lookback:]
+
+        return recent
 
     def retrieve_all(self) -> list:
         """
         Retrieves all values from memory.
         """
-        return copy.copy(self.memory)
+        return self.memory[:]
 
     def retrieve_relevant(self, relevance_target: str, top_k:int) -> list:
         """
@@ -1987,21 +2194,34 @@ class EpisodicMemory(TinyMemory):
         """
         raise NotImplementedError("Subclasses must implement this method.")
 
+    def last(self) -> Any:
+        """
+        Retrieves the most recent value from memory, or None if the memory is empty. Unlike retrieve_all(),
+        this does not copy the whole memory.
+        """
+        return self.memory[-1] if self.memory else None
+
     def retrieve_first(self, n: int, include_omission_info:bool=True) -> list:
         """
         Retrieves the first n values from memory.
         """
-        omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
-        
-        return self.memory[:n] + omisssion_info
+        # the slice is already a new list, so the omission info is added to it rather than concatenated into yet another
+        first = self.memory[:n]
+        if include_omission_info:
+            first.append(EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO)
+
+        return first
     
     def retrieve_last(self, n: int, include_omission_info:bool=True) -> list:
         """
         Retrieves the last n values from memory.
         """
-        omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
+        # the slice is already a new list, so the omission info is added to it rather than concatenated into yet another
+        last = self.memory[-n:]
+        if include_omission_info:
+            last.insert(0, EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO)
 
-        return omisssion_info + self.memory[-n:]
+        return last
 
 
 class SemanticMemory(TinyMemory):
@@ -2011,10 +2231,17 @@ class SemanticMemory(TinyMemory):
     of semantic memory, where the agent can store and retrieve semantic information.
     """
 
-    suppress_attributes_from_serialization = ["index"]
+    suppress_attributes_from_serialization = ["index", "_retrieval_cache"]
+
+    # how many web pages are fetched at the same time when adding web URLs
+    MAX_CONCURRENT_WEB_FETCHES = 8
+
+    # how many retrieval results are kept, so that repeated retrievals don't need to query the index again
+    MAX_CACHED_RETRIEVALS = 256
 
     def __init__(self, documents_paths: list=None, web_urls: list=None) -> None:
         self.index = None
+        self._retrieval_cache = {}
         
         self.documents_paths = []
         self.documents_web_urls = []
@@ -2053,12 +2280,31 @@ class SemanticMemory(TinyMemory):
         """
         Retrieves all values from memory that are relevant to a given target.
         """
-        if self.index is not None:
+        return self.retrieve_relevant_batch([relevance_target], top_k=top_k)[0]
+
+    def retrieve_relevant_batch(self, relevance_targets:list, top_k=20) -> list:
+        """
+        Retrieves all values from memory that are relevant to each of several targets. Each distinct target is
+        retrieved once, and only if its result is not cached already. Returns one list of values per target.
+        """
+        if self.index is None:
+            return [[] for _ in relevance_targets]
+
+        # the results only change when documents are added, which clears the cache
+        retrieved_per_target = {target: self._retrieval_cache.get((target, top_k)) for target in relevance_targets}
+        missing_targets = [target for target, retrieved in retrieved_per_target.items() if retrieved is None]
+
+        if len(missing_targets) > 0:
+            # the retriever embeds each target as a query, which embedding models might do differently than 
+            # for documents, so the targets are not embedded together as if they were documents
             retriever = self.index.as_retriever(similarity_top_k=top_k)
-            nodes = retriever.retrieve(relevance_target)
-        else:
-            nodes = []
+            for target in missing_targets:
+                retrieved_per_target[target] = self._format_retrieved_nodes(retriever.retrieve(target))
+                self._cache_retrieval((target, top_k), retrieved_per_target[target])
+
+        return [list(retrieved_per_target[target]) for target in relevance_targets]
 
+    def _format_retrieved_nodes(self, nodes) -> list:
         retrieved = []
         for node in nodes:
             content = "SOURCE: " + node.metadata.get('file_name', '(unknown)')
@@ -2069,6 +2315,12 @@ class SemanticMemory(TinyMemory):
             logger.debug(f"Semantic memory retrieved: {content[:200]}")
 
         return retrieved
+
+    def _cache_retrieval(self, cache_key, retrieved:list) -> None:
+        self._retrieval_cache[cache_key] = retrieved
+        if len(self._retrieval_cache) > SemanticMemory.MAX_CACHED_RETRIEVALS:
+            # forget the oldest retrieval
+            del self._retrieval_cache[next(iter(self._retrieval_cache))]
     
     def retrieve_document_content_by_name(self, document_name:str) -> str:
         """
@@ -2096,28 +2348,38 @@ class SemanticMemory(TinyMemory):
     
     def add_documents_paths(self, documents_paths:list) -> None:
         """
-        Adds a path to a folder with documents used for semantic memory.
+        Adds paths to folders with documents used for semantic memory. The documents of all folders are 
+        indexed together, so that they are embedded in as few batches as possible.
         """
 
         if documents_paths is not None:
+            new_documents = []
             for documents_path in documents_paths:
                 try:
-                    self.add_documents_path(documents_path)
+                    new_documents += self._load_documents_path(documents_path)
                 except (FileNotFoundError, ValueError) as e:
                     print(f"Error: {e}")
                     print(f"Current working directory: {os.getcwd()}")
                     print(f"Provided path: {documents_path}")
                     print("Please check if the path exists and is accessible.")
+            
+            self._add_documents(new_documents, lambda doc: doc.metadata["file_name"])
 
     def add_documents_path(self, documents_path:str) -> None:
         """
         Adds a path to a folder with documents used for semantic memory.
         """
+        self._add_documents(self._load_documents_path(documents_path), lambda doc: doc.metadata["file_name"])
 
-        if documents_path not in self.documents_paths:
-            self.documents_paths.append(documents_path)
-            new_documents = SimpleDirectoryReader(documents_path).load_data()
-            self._add_documents(new_documents, lambda doc: doc.metadata["file_name"])
+    def _load_documents_path(self, documents_path:str) -> list:
+        """
+        Loads the documents in a folder, unless that folder was already added to the semantic memory.
+        """
+        if documents_path in self.documents_paths:
+            return []
+
+        self.documents_paths.append(documents_path)
+        return SimpleDirectoryReader(documents_path).load_data()
     
     def add_document_path(self, document_path:str) -> None:
         """
@@ -2136,7 +2398,17 @@ class SemanticMemory(TinyMemory):
         self.documents_web_urls += filtered_web_urls
 
         if len(filtered_web_urls) > 0:
-            new_documents = SimpleWebPageReader(html_to_text=True).load_data(filtered_web_urls)
+            # the web readers are only imported when needed, since importing them is slow
+            from llama_index.readers.web import SimpleWebPageReader
+
+            # the reader fetches the pages one after the other, so each page is read separately, concurrently with the others,
+            # and the documents are then put back in the order of the URLs
+            reader = SimpleWebPageReader(html_to_text=True)
+            max_workers = min(SemanticMemory.MAX_CONCURRENT_WEB_FETCHES, len(filtered_web_urls))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                documents_per_url = executor.map(lambda url: reader.load_data([url]), filtered_web_urls)
+                new_documents = [document for documents in documents_per_url for document in documents]
+
             self._add_documents(new_documents, lambda doc: doc.id_)
     
     def add_web_url(self, web_url:str) -> None:
@@ -2157,6 +2429,12 @@ class SemanticMemory(TinyMemory):
         """
         Adds documents to the semantic memory.
         """
+        # documents whose names were already added before are skipped, so that they are not indexed twice; 
+        # documents with the same name in this batch (e.g., the pages of a PDF file) are all kept
+        if doc_to_name_func is not None:
+            known_names = set(self.filename_to_document)
+            new_documents = [document for document in new_documents if doc_to_name_func(document) not in known_names]
+
         # index documents by name
         if len(new_documents) > 0:
             # add the new documents to the list of documents
@@ -2166,17 +2444,18 @@ class SemanticMemory(TinyMemory):
             for document in new_documents:
                 
                 # out of an abundance of caution, we sanitize the text
-                document.text = utils.sanitize_raw_string(document.text)
+                document.set_content(utils.sanitize_raw_string(document.text))
 
                 if doc_to_name_func is not None:
-                    name = doc_to_name_func(document)
-                    self.filename_to_document[name] = document
+                    self.filename_to_document.setdefault(doc_to_name_func(document), document)
 
-            # index documents for semantic retrieval
+            # index documents for semantic retrieval, which makes previous retrievals stale
+            self._retrieval_cache.clear()
             if self.index is None:
-                self.index = VectorStoreIndex.from_documents(self.documents)
+                self.index = VectorStoreIndex.from_documents(self.documents, embed_model=_setup_embedding_model(),
+                                                             storage_context=StorageContext.from_defaults(vector_store=_MatrixVectorStore()))
             else:
-                self.index.refresh(self.documents)
+                self.index.refresh(new_documents)
 
 
     ###########################################################
@@ -2187,5 +2466,6 @@ class SemanticMemory(TinyMemory):
         super()._post_deserialization_init()
     
         self.index = None
+        self._retrieval_cache = {}
         self.add_documents_paths(self.documents_paths)
         self.add_web_urls(self.documents_web_urls)
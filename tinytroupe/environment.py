@@ -6,6 +6,8 @@ agents interact with each other as well as external entities (e.g., search engin
 import logging
 logger = logging.getLogger("tinytroupe")
 import copy
+import collections
+import concurrent.futures
 from datetime import datetime, timedelta
 
 from tinytroupe.agent import *
@@ -29,10 +31,15 @@ class TinyWorld:
     # Whether to display environments communications or not, for all environments. 
     communication_display = True
 
+    # The maximum number of displayed communications kept in the buffer until they are popped. Older ones are dropped,
+    # so that environments run outside of a simulation (which would otherwise pop them regularly) do not grow without bound.
+    MAX_DISPLAYED_COMMUNICATIONS = 10000
+
     def __init__(self, name: str="A TinyWorld", agents=[], 
                  initial_datetime=datetime.datetime.now(),
                  broadcast_if_no_target=True,
-                 max_additional_targets_to_display=3):
+                 max_additional_targets_to_display=3,
+                 parallelize_agents_actions=False):
         """
         Initializes an environment.
 
@@ -44,11 +51,16 @@ class TinyWorld:
             broadcast_if_no_target (bool): If True, broadcast actions if the target of an action is not found.
             max_additional_targets_to_display (int): The maximum number of additional targets to display in a communication. If None, 
                 all additional targets are displayed.
+            parallelize_agents_actions (bool): If True, at each step all agents act concurrently, and only then are their actions
+                handled, in the order of the agents. This overlaps the agents' model calls, but agents no longer see, within a step, 
+                what the agents before them did in that same step. Ignored within a simulation scope, since simulation caching 
+                requires a deterministic order of execution.
         """
 
         self.name = name
         self.current_datetime = initial_datetime
         self.broadcast_if_no_target = broadcast_if_no_target
+        self.parallelize_agents_actions = parallelize_agents_actions
         self.simulation_id = None # will be reset later if the agent is used within a specific simulation scope
         
         
@@ -57,7 +69,7 @@ class TinyWorld:
 
         # the buffer of communications that have been displayed so far, used for
         # saving these communications to another output form later (e.g., caching)
-        self._displayed_communications_buffer = []
+        self._displayed_communications_buffer = collections.deque(maxlen=TinyWorld.MAX_DISPLAYED_COMMUNICATIONS)
 
         # a temporary buffer for communications target to make rendering easier
         self._target_display_communications_buffer = []
@@ -88,12 +100,22 @@ class TinyWorld:
 
         # agents can act
         agents_actions = {}
-        for agent in self.agents:
-            logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
-            actions = agent.act(return_actions=True)
-            agents_actions[agent.name] = actions
+        if self.parallelize_agents_actions and control.current_simulation() is None:
+            logger.debug(f"[{self.name}] All agents are acting concurrently.")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.agents))) as executor:
+                all_actions = list(executor.map(lambda agent: agent.act(return_actions=True), self.agents))
+
+            for agent, actions in zip(self.agents, all_actions):
+                agents_actions[agent.name] = actions
+                self._handle_actions(agent, agent.pop_latest_actions())
+
+        else:
+            for agent in self.agents:
+                logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting.")
+                actions = agent.act(return_actions=True)
+                agents_actions[agent.name] = actions
 
-            self._handle_actions(agent, agent.pop_latest_actions())
+                self._handle_actions(agent, agent.pop_latest_actions())
         
         return agents_actions
 
@@ -574,17 +596,20 @@ class TinyWorld:
 
 
         self._displayed_communications_buffer.append(communication)
+
         self._display(communication)
 
     def pop_and_display_latest_communications(self):
         """
         Pops the latest communications and displays them.
         """
-        communications = self._displayed_communications_buffer
-        self._displayed_communications_buffer = []
+        communications = list(self._displayed_communications_buffer)
+        self._displayed_communications_buffer.clear()
 
-        for communication in communications:
-            self._display(communication)
+        # the console's buffer collects all of them, so that they are written out at once
+        with self.console:
+            for communication in communications:
+                self._display(communication)
 
         return communications    
 
@@ -604,7 +629,7 @@ class TinyWorld:
         """
         Cleans the communications buffer.
         """
-        self._displayed_communications_buffer = []
+        self._displayed_communications_buffer.clear()
 
     def __repr__(self):
         return f"TinyWorld(name='{self.name}')"
@@ -657,6 +682,7 @@ class TinyWorld:
         del to_copy['current_datetime']
 
         state = copy.deepcopy(to_copy)
+        state["_displayed_communications_buffer"] = list(state["_displayed_communications_buffer"])
 
         # agents are encoded separately
         state["agents"] = [agent.encode_complete_state() for agent in self.agents]
@@ -703,6 +729,8 @@ class TinyWorld:
 
         # restore other fields
         self.__dict__.update(state)
+        self._displayed_communications_buffer = collections.deque(self._displayed_communications_buffer, 
+                                                                  maxlen=TinyWorld.MAX_DISPLAYED_COMMUNICATIONS)
 
         return self
 
@@ -740,10 +768,7 @@ class TinyWorld:
         Returns:
             TinyWorld: The environment with the specified name.
         """
-        if name in TinyWorld.all_environments:
-            return TinyWorld.all_environments[name]
-        else:
-            return None
+        return TinyWorld.all_environments.get(name, None)
     
     @staticmethod
     def clear_environments():
@@ -754,7 +779,7 @@ class TinyWorld:
 
 class TinySocialNetwork(TinyWorld):
 
-    def __init__(self, name, broadcast_if_no_target=True):
+    def __init__(self, name, broadcast_if_no_target=True, parallelize_agents_actions=False):
         """
         Create a new TinySocialNetwork environment.
 
@@ -762,9 +787,11 @@ class TinySocialNetwork(TinyWorld):
             name (str): The name of the environment.
             broadcast_if_no_target (bool): If True, broadcast actions through an agent's available relations
               if the target of an action is not found.
+            parallelize_agents_actions (bool): If True, all agents act concurrently at each step. See TinyWorld.
         """
         
-        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target)
+        super().__init__(name, broadcast_if_no_target=broadcast_if_no_target, 
+                         parallelize_agents_actions=parallelize_agents_actions)
 
         self.relations = {}
     
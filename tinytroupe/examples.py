@@ -3,9 +3,39 @@ Some examples of how to use the tinytroupe library. These can be used directly o
 agents.
 """
 
+import copy
+import functools
+
 from tinytroupe.agent import TinyPerson
+from tinytroupe.control import current_simulation
+
+# The specifications of the examples already built, by factory name.
+_example_specs = {}
+
+def _reuse_spec(factory):
+  """
+  The first call to the decorated factory builds the agent step by step, as shown below, and keeps a copy
+  of the resulting specification. Later calls copy that specification into a new agent instead, so the
+  prompt is rendered once rather than once per definition. Within a simulation the agent is always
+  built step by step, so that its definitions are recorded like any other transaction.
+  """
+  @functools.wraps(factory)
+  def wrapper():
+    spec = _example_specs.get(factory.__name__)
+    if spec is None or current_simulation() is not None:
+      agent = factory()
+      _example_specs[factory.__name__] = copy.deepcopy(agent._configuration)
+      return agent
+
+    agent = TinyPerson(spec["name"])
+    agent._configuration = copy.deepcopy(spec)
+    agent.reset_prompt()
+    return agent
+
+  return wrapper
 
 # Example 1: Oscar, the architect
+@_reuse_spec
 def create_oscar_the_architect():
   oscar = TinyPerson("Oscar")
 
@@ -67,6 +97,7 @@ def create_oscar_the_architect():
   return oscar
 
 # Example 2: Lisa, the Data Scientist
+@_reuse_spec
 def create_lisa_the_data_scientist():
   lisa = TinyPerson("Lisa")
 
@@ -127,6 +158,7 @@ def create_lisa_the_data_scientist():
   return lisa
 
 # Example 3: Marcos, the physician
+@_reuse_spec
 def create_marcos_the_physician():
 
   marcos = TinyPerson("Marcos")
@@ -212,6 +244,7 @@ def create_marcos_the_physician():
 
 
 # Example 4: Lila, the Linguist
+@_reuse_spec
 def create_lila_the_linguist():
 
   lila = TinyPerson("Lila")
@@ -125,7 +125,7 @@ class ResultsExtractor:
         
         messages.append({"role": "system", 
                          "content": chevron.render(
-                             open(self._extraction_prompt_template_path).read(), 
+                             utils.tokenized_template(self._extraction_prompt_template_path), 
                              rendering_configs)})
 
 
@@ -202,7 +202,7 @@ performed.
         
         messages.append({"role": "system", 
                          "content": chevron.render(
-                             open(self._extraction_prompt_template_path).read(), 
+                             utils.tokenized_template(self._extraction_prompt_template_path), 
                              rendering_configs)})
 
         # TODO: either summarize first or break up into multiple tasks
@@ -164,7 +164,7 @@ class TinyPersonFactory(TinyFactory):
         #
         # For the minibios, we only need to keep track of the ones generated by this factory, since they are unique to each factory
         # and are used to guide the sampling process.
-        prompt = chevron.render(open(self.person_prompt_template_path).read(), {
+        prompt = chevron.render(utils.tokenized_template(self.person_prompt_template_path), {
             "context": self.context_text,
             "agent_particularities": agent_particularities,
             "already_generated_minibios": self.generated_minibios,
@@ -266,11 +266,13 @@ class TinyPersonFactory(TinyFactory):
         """
         Sets up the agent with the necessary elements.
         """
-        for key, value in configuration.items():
-            if isinstance(value, list):
-                agent.define_several(key, value)
-            else:
-                agent.define(key, value)
+        # the prompt is only rendered once, after the whole configuration is in
+        with agent.batched_updates():
+            for key, value in configuration.items():
+                if isinstance(value, list):
+                    agent.define_several(key, value)
+                else:
+                    agent.define(key, value)
         
         # does not return anything, as we don't want to cache the agent object itself.
     
@@ -3,8 +3,11 @@ import openai
 from openai import OpenAI, AzureOpenAI
 import time
 import json
+import copy
 import pickle
+import hashlib
 import logging
+import threading
 import configparser
 import tiktoken
 from tinytroupe import utils
@@ -101,17 +104,18 @@ class LLMRequest:
 # Client class
 ###########################################################################
 
-class OpenAIClient:
+class CachingClientMixin:
     """
-    A utility class for interacting with the OpenAI API.
+    Mixin for LLM clients that can cache API calls on disk, so that identical requests are not sent again.
+    Cache entries are keyed by a hash of the full request.
     """
 
-    def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
-        logger.debug("Initializing OpenAIClient")
+    # request parameters that only affect how the request is transported (or routed), not its response
+    _CACHE_KEY_IGNORED_PARAMS = ("timeout", "extra_body")
+
+    # several agents may call the model concurrently, and their cache records must not be interleaved in the file
+    _cache_file_lock = threading.Lock()
 
-        # should we cache api calls and reuse them?
-        self.set_api_cache(cache_api_calls, cache_file_name)
-    
     def set_api_cache(self, cache_api_calls, cache_file_name=default["cache_file_name"]):
         """
         Enables or disables the caching of API calls.
@@ -124,7 +128,85 @@ class OpenAIClient:
         if self.cache_api_calls:
             # load the cache, if any
             self.api_cache = self._load_cache()
+
+    @staticmethod
+    def _cache_key(model, request_params):
+        """
+        Computes a stable cache key for the given model and request parameters. Any parameter that
+        is not JSON serializable is converted to its string representation.
+        """
+        params = {k: v for k, v in request_params.items() if k not in CachingClientMixin._CACHE_KEY_IGNORED_PARAMS}
+        serialized_request = utils.compact_json_dumps({"model": model, "params": params}, sort_keys=True)
+        return hashlib.sha256(serialized_request.encode("utf-8")).hexdigest()
+
+    def _save_cache(self):
+        """
+        Saves the whole API cache to disk, replacing the cache file. We use pickle to do that because some obj
+        are not JSON serializable.
+        """
+        # use pickle to save the cache
+        with open(self.cache_file_name, "wb") as f:
+            pickle.dump(self.api_cache, f)
+
+    def _append_to_cache(self, cache_key, response):
+        """
+        Appends a single cache entry to the cache file, so that the file does not need to be 
+        rewritten in full every time a new API call is cached.
+        """
+        # pickle the record first, so it is written with a single call
+        record = pickle.dumps((cache_key, response))
+        with CachingClientMixin._cache_file_lock:
+            with open(self.cache_file_name, "ab") as f:
+                f.write(record)
     
+    def _load_cache(self):
+
+        """
+        Loads the API cache from disk. The cache file is a sequence of pickled records, each being either
+        a single (key, response) entry or a whole cache dictionary (as written by _save_cache).
+        """
+        cache = {}
+        if os.getenv("TINYTROUPE_CACHE_BUST"):
+            # ignore whatever was cached before; new entries are still appended, and take precedence when loaded later
+            logger.info(f"TINYTROUPE_CACHE_BUST is set, so the API cache file {self.cache_file_name} is not loaded.")
+        
+        elif os.path.exists(self.cache_file_name):
+            with open(self.cache_file_name, "rb") as f:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError, TypeError, AttributeError) as e:
+                        # a partially written record (e.g., if the process was interrupted), nothing else to read
+                        logger.warning(f"Ignoring the rest of the API cache file {self.cache_file_name}: {e}")
+                        break
+
+                    if isinstance(record, dict):
+                        cache.update(record)
+                    else:
+                        cache_key, response = record
+                        cache[cache_key] = response
+        
+        return cache
+
+
+class OpenAIClient(CachingClientMixin):
+    """
+    A utility class for interacting with the OpenAI API.
+    """
+
+    # whether the API accepts the prompt_cache_key routing hint
+    supports_prompt_cache_key = True
+
+    def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
+        logger.debug("Initializing OpenAIClient")
+
+        # the underlying API client is only created when first needed
+        self.client = None
+
+        # should we cache api calls and reuse them?
+        self.set_api_cache(cache_api_calls, cache_file_name)
     
     def _setup_from_config(self):
         """
@@ -147,7 +229,8 @@ class OpenAIClient:
                      exponential_backoff_factor=default["exponential_backoff_factor"],
                      n = 1,
                      response_format=None,
-                     echo=False):
+                     echo=False,
+                     prompt_cache_key=None):
         """
         Sends a message to the OpenAI API and returns the response.
 
@@ -164,6 +247,8 @@ class OpenAIClient:
         timeout (int): The maximum number of seconds to wait for a response from the API.
         waiting_time (int): The number of seconds to wait between requests.
         exponential_backoff_factor (int): The factor by which to increase the waiting time between requests.
+        prompt_cache_key (str): Identifies requests that share a long prompt prefix (e.g., the same system message), so 
+          that the API can route them to where that prefix is already cached.
         n (int): The number of completions to generate.
         response_format (str): The format of the response. If None, the response is returned as a dictionary.
 
@@ -184,8 +269,10 @@ class OpenAIClient:
             # exponential backoff
             waiting_time = waiting_time * exponential_backoff_factor
 
-        # setup the OpenAI configurations for this client.
-        self._setup_from_config()
+        # setup the OpenAI configurations for this client. This is done only once, so that the underlying 
+        # HTTP connections are kept alive and reused across calls.
+        if self.client is None:
+            self._setup_from_config()
         
         # We need to adapt the parameters to the API type, so we create a dictionary with them first
         chat_api_params = {
@@ -205,6 +292,10 @@ class OpenAIClient:
         if response_format is not None:
             chat_api_params["response_format"] = response_format
 
+        if prompt_cache_key is not None and self.supports_prompt_cache_key:
+            # passed as an extra body parameter, so that it works with any version of the openai package
+            chat_api_params["extra_body"] = {"prompt_cache_key": prompt_cache_key}
+
         i = 0
         while i < max_attempts:
             try:
@@ -221,7 +312,7 @@ class OpenAIClient:
                 ###############################################################
                 # call the model, either from the cache or from the API
                 ###############################################################
-                cache_key = str((model, chat_api_params)) # need string to be hashable
+                cache_key = self._cache_key(model, chat_api_params)
                 if self.cache_api_calls and (cache_key in self.api_cache):
                     response = self.api_cache[cache_key]
                 else:
@@ -232,7 +323,7 @@ class OpenAIClient:
                     response = self._raw_model_call(model, chat_api_params)
                     if self.cache_api_calls:
                         self.api_cache[cache_key] = response
-                        self._save_cache()
+                        self._append_to_cache(cache_key, response)
                 
                 
                 logger.debug(f"Got response from API: {response}")
@@ -351,23 +442,6 @@ class OpenAIClient:
             logger.error(f"Error counting tokens: {e}")
             return None
 
-    def _save_cache(self):
-        """
-        Saves the API cache to disk. We use pickle to do that because some obj
-        are not JSON serializable.
-        """
-        # use pickle to save the cache
-        pickle.dump(self.api_cache, open(self.cache_file_name, "wb"))
-
-    
-    def _load_cache(self):
-
-        """
-        Loads the API cache from disk.
-        """
-        # unpickle
-        return pickle.load(open(self.cache_file_name, "rb")) if os.path.exists(self.cache_file_name) else {}
-
     def get_embedding(self, text, model=default["embedding_model"]):
         """
         Gets the embedding of the given text using the specified model.
@@ -379,6 +453,9 @@ class OpenAIClient:
         Returns:
         The embedding of the text.
         """
+        if self.client is None:
+            self._setup_from_config()
+
         response = self._raw_embedding_model_call(text, model)
         return self._raw_embedding_model_response_extractor(response)
     
@@ -401,6 +478,9 @@ class OpenAIClient:
 
 class AzureClient(OpenAIClient):
 
+    # not all API versions accept it
+    supports_prompt_cache_key = False
+
     def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
         logger.debug("Initializing AzureClient")
 
@@ -415,15 +495,24 @@ class AzureClient(OpenAIClient):
                                   api_version = config["OpenAI"]["AZURE_API_VERSION"],
                                   api_key = os.getenv("AZURE_OPENAI_KEY"))
     
-class OllamaClient:
-    def __init__(self, base_url, model, temperature=0.3, top_p=0.95, timeout=60, quick_model=None):
+class OllamaClient(CachingClientMixin):
+    def __init__(self, base_url, model, temperature=0.3, top_p=0.95, timeout=60, quick_model=None,
+                 cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]):
+        """
+        Initializes the client. Several servers (e.g., replicas of the same model) can be given as a comma-separated
+        list of URLs in `base_url`, in which case each request goes to the server with the fewest requests
+        in progress, falling back to the others if it cannot be reached.
+        """
         from urllib.parse import urlparse
 
-        parsed_url = urlparse(base_url)
+        self.base_urls = [url.strip() for url in base_url.split(",") if url.strip()]
+        if len(self.base_urls) == 0:
+            raise ValueError(f"No Ollama server URL was given (base_url={base_url!r}).")
+        parsed_url = urlparse(self.base_urls[0])
 
         # 提取基础URL
         client_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-        self.base_url = base_url
+        self.base_url = self.base_urls[0]
         self.model = model
         self.temperature = temperature
         self.top_p = top_p
@@ -434,9 +523,21 @@ class OllamaClient:
             host=client_url
         )
 
-    def send_message(self, messages, temperature=0.1, response_format=None, is_quick=False):
+        # a single session, so that HTTP connections to the server are kept alive and reused across calls
+        self.session = requests.Session()
+
+        # how many requests are currently in progress for each server, to balance the load among them
+        self._requests_in_progress = {url: 0 for url in self.base_urls}
+        self._requests_in_progress_lock = threading.Lock()
+
+        # should we cache api calls and reuse them?
+        self.set_api_cache(cache_api_calls, cache_file_name)
+
+    def send_message(self, messages, temperature=0.1, response_format=None, is_quick=False, prompt_cache_key=None):
         """
-        Sends a message to the Ollama API and returns the full JSON response.
+        Sends a message to the Ollama API and returns the full JSON response. Requests with the same
+        `prompt_cache_key` (i.e., sharing a prompt prefix) preferably go to the same server, which can then 
+        reuse what it already computed for that prefix.
         """
         if is_quick:
             model = self.quick_model
@@ -466,15 +567,28 @@ class OllamaClient:
                 },
             }
         
+        # call the model, either from the cache or from the API
+        cache_key = self._cache_key(model, payload)
+        if self.cache_api_calls and (cache_key in self.api_cache):
+            # a copy, so that callers cannot change the cached message
+            return copy.deepcopy(self.api_cache[cache_key])
+        
+        message = self._raw_model_call(payload, prompt_cache_key)
+
+        # errors are not cached, so that the request is tried again next time. A copy is cached, since the
+        # message itself is returned to the caller, who might change it.
+        if self.cache_api_calls and ("error" not in message):
+            self.api_cache[cache_key] = copy.deepcopy(message)
+            self._append_to_cache(cache_key, message)
         
+        return message
+
+    def _raw_model_call(self, payload, prompt_cache_key=None):
+        """
+        Calls the Ollama API with the given payload, returning the resulting message (or an error description).
+        """
         try:
-            response = requests.post(
-                self.base_url,
-                json=payload,
-                timeout=self.timeout,
-                proxies={}
-            )
-            response.raise_for_status()
+            response = self._post_to_least_busy_server(payload, prompt_cache_key)
             
             # response_client = self.client.chat(model=self.model, messages=messages,
             #                  options={'temperature':self.temperature, 'top_p':self.top_p, 'num_ctx':35000}, format=response_format)
@@ -513,6 +627,47 @@ class OllamaClient:
         except ValueError as e:
             logger.error(f"Failed to parse API response: {e}")
             return {"error": "Invalid JSON response"}
+
+    def _post_to_least_busy_server(self, payload, prompt_cache_key=None):
+        """
+        Posts the payload to the server with the fewest requests in progress. If that fails, 
+        the other servers are tried in turn, and the last error is raised if none succeeds.
+        Among equally busy servers, the one assigned to `prompt_cache_key` (if any) is preferred.
+        """
+        preferred_url = None
+        if prompt_cache_key is not None:
+            preferred_url = self.base_urls[int(hashlib.sha256(prompt_cache_key.encode("utf-8")).hexdigest(), 16) % len(self.base_urls)]
+
+        with self._requests_in_progress_lock:
+            urls = sorted(self.base_urls, key=lambda url: (self._requests_in_progress[url], url != preferred_url))
+
+        last_error = None
+        for url in urls:
+            with self._requests_in_progress_lock:
+                self._requests_in_progress[url] += 1
+            
+            try:
+                response = self.session.post(
+                    url,
+                    json=payload,
+                    timeout=self.timeout,
+                    proxies={}
+                )
+                response.raise_for_status()
+                return response
+            
+            except requests.exceptions.RequestException as e:
+                if len(urls) > 1:
+                    logger.warning(f"Error communicating with Ollama server {url}, trying another one if available: {e}")
+                last_error = e
+            
+            finally:
+                with self._requests_in_progress_lock:
+                    self._requests_in_progress[url] -= 1
+        
+        raise last_error
+
+
 ###########################################################################
 # Exceptions
 ###########################################################################
@@ -604,7 +759,8 @@ def force_api_cache(cache_api_calls, cache_file_name=default["cache_file_name"])
 register_client("openai", OpenAIClient())
 register_client("azure", AzureClient())
 register_client("ollama", OllamaClient(
-    base_url=config["Ollama"].get("BASE_URL"),
+    # the TINYTROUPE_ENDPOINTS environment variable can override the configured server(s), as a comma-separated list of URLs
+    base_url=os.getenv("TINYTROUPE_ENDPOINTS") or config["Ollama"].get("BASE_URL"),
     model=config["Ollama"].get("MODEL"),
     temperature=float(config["Ollama"].get("TEMPERATURE", 0.7)),
     top_p=float(config["Ollama"].get("TOP_P", 0.95)),
@@ -16,6 +16,9 @@ from tinytroupe.utils import JsonSerializableRegistry
 
 class TinyTool(JsonSerializableRegistry):
 
+    # The action types this tool can process, so that it is only offered those. None means the tool may process any action.
+    handled_action_types = None
+
     def __init__(self, name, description, owner=None, real_world_side_effects=False, exporter=None, enricher=None):
         """
         Initialize a new tool.
@@ -60,12 +63,14 @@ class TinyTool(JsonSerializableRegistry):
     def process_action(self, agent, action: dict) -> bool:
         self._protect_real_world()
         self._enforce_ownership(agent)
-        self._process_action(agent, action)
+        return self._process_action(agent, action)
 
 
 # TODO under development
 class TinyCalendar(TinyTool):
 
+    handled_action_types = ("CREATE_EVENT",)
+
     def __init__(self, owner=None):
         super().__init__("calendar", "A basic calendar tool that allows agents to keep track meetings and appointments.", owner=owner, real_world_side_effects=False)
         
@@ -127,6 +132,8 @@ class TinyCalendar(TinyTool):
 
 class TinyWordProcessor(TinyTool):
 
+    handled_action_types = ("WRITE_DOCUMENT",)
+
     def __init__(self, owner=None, exporter=None, enricher=None):
         super().__init__("wordprocessor", "A basic word processor tool that allows agents to write documents.", owner=owner, real_world_side_effects=False, exporter=exporter, enricher=enricher)
         
@@ -3,14 +3,17 @@ General utilities and convenience functions.
 """
 import re
 import json
+import orjson
 import os
 import sys
+import time
+import random
 import hashlib
 import textwrap
 import logging
 import chevron
 import copy
-from functools import wraps
+from functools import wraps, lru_cache
 from collections import defaultdict
 from typing import Collection
 from datetime import datetime
@@ -41,17 +44,38 @@ def compose_initial_LLM_messages_with_templates(system_template_name:str, user_t
 
     messages.append({"role": "system", 
                          "content": chevron.render(
-                             open(system_prompt_template_path).read(), 
+                             tokenized_template(system_prompt_template_path), 
                              rendering_configs)})
     
     # optionally add a user message
     if user_template_name is not None:
         messages.append({"role": "user", 
                             "content": chevron.render(
-                                    open(user_prompt_template_path).read(), 
+                                    tokenized_template(user_prompt_template_path), 
                                     rendering_configs)})
     return messages
 
+@lru_cache(maxsize=None)
+def tokenized_template(template_path:str) -> tuple:
+    """
+    Reads and tokenizes the Mustache template at the specified path. The result can be given directly to
+    chevron.render, and is cached, so that each template is read and parsed only once, no matter how many
+    times it is rendered.
+    """
+    with open(template_path, "r") as f:
+        return tuple(chevron.tokenizer.tokenize(f.read()))
+
+def compact_json_dumps(obj, sort_keys:bool=False) -> str:
+    """
+    Serializes an object to a compact JSON string, without whitespace and keeping non-ASCII characters as they are.
+    This is much faster than json.dumps, and the result also takes fewer tokens when sent to a model.
+    Values that are not JSON serializable are converted to their string representation.
+    """
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+
+    return orjson.dumps(obj, option=option, default=str).decode("utf-8")
 
 ################################################################################	
 # Model output utilities
@@ -63,11 +87,16 @@ def extract_json(text: str) -> dict:
     """
     try:
 
-        # remove any text before the first opening curly or square braces, using regex. Leave the braces.
-        text = re.sub(r'^.*?({|\[)', r'\1', text, flags=re.DOTALL)
+        # remove any text before the first opening curly or square braces. Leave the braces.
+        # (Plain index scans are used for this and the step below, since they are linear in the length of the text,
+        # whereas the equivalent regexes can backtrack heavily on long LLM outputs.)
+        start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=0)
 
-        # remove any trailing text after the LAST closing curly or square braces, using regex. Leave the braces.
-        text  =  re.sub(r'(}|\])(?!.*(\]|\})).*$', r'\1', text, flags=re.DOTALL)
+        # remove any trailing text after the LAST closing curly or square braces. Leave the braces.
+        end = max(text.rfind('}'), text.rfind(']'))
+        end = end + 1 if end >= start else len(text)
+
+        text = text[start:end]
         
         # remove invalid escape sequences, which show up sometimes
         # replace \' with just '
@@ -103,15 +132,22 @@ def extract_code_block(text: str) -> str:
 # Model control utilities
 ################################################################################    
 
-def repeat_on_error(retries:int, exceptions:list):
+def repeat_on_error(retries:int, exceptions:list, initial_wait:float=0.0, max_wait:float=16.0):
     """
     Decorator that repeats the specified function call if an exception among those specified occurs, 
     up to the specified number of retries. If that number of retries is exceeded, the
-    exception is raised. If no exception occurs, the function returns normally.
+    exception is raised. If no exception occurs, the function returns normally. Exceptions that
+    are not among those specified are raised immediately.
+
+    Optionally, the retries can be spaced using exponential backoff with jitter, which is useful when
+    the errors come from an overloaded or rate-limited service. By default, retries are immediate.
 
     Args:
         retries (int): The number of retries to attempt.
         exceptions (list): The list of exception classes to catch.
+        initial_wait (float, optional): The maximum wait, in seconds, before the first retry. It doubles at each subsequent retry,
+          and the actual wait is drawn uniformly up to that value (i.e., "full jitter"). Defaults to 0.0, meaning no wait.
+        max_wait (float, optional): The upper bound, in seconds, for the wait before any retry. Defaults to 16.0.
     """
     def decorator(func):
         def wrapper(*args, **kwargs):
@@ -124,6 +160,8 @@ def repeat_on_error(retries:int, exceptions:list):
                         raise e
                     else:
                         logger.debug(f"Retrying ({i+1}/{retries})...")
+                        if initial_wait > 0:
+                            time.sleep(random.uniform(0, min(max_wait, initial_wait * (2 ** i))))
                         continue
         return wrapper
     return decorator
@@ -196,19 +234,26 @@ def add_rai_template_variables_if_enabled(template_variables: dict) -> dict:
     )
 
     # Harmful content
-    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_harmful_content_prevention.md"), "r") as f:
-        rai_harmful_content_prevention_content = f.read()
+    rai_harmful_content_prevention_content = _read_prompt_file("rai_harmful_content_prevention.md")
 
     template_variables['rai_harmful_content_prevention'] = rai_harmful_content_prevention_content if rai_harmful_content_prevention else None
 
     # Copyright infringement
-    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_copyright_infringement_prevention.md"), "r") as f:
-        rai_copyright_infringement_prevention_content = f.read()
+    rai_copyright_infringement_prevention_content = _read_prompt_file("rai_copyright_infringement_prevention.md")
 
     template_variables['rai_copyright_infringement_prevention'] = rai_copyright_infringement_prevention_content if rai_copyright_infringement_prevention else None
 
     return template_variables
 
+@lru_cache(maxsize=None)
+def _read_prompt_file(file_name:str) -> str:
+    """
+    Reads a file from the prompts directory. The contents are cached, since these files are read 
+    every time an agent's prompt is generated.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "prompts", file_name), "r") as f:
+        return f.read()
+
 ################################################################################
 # Rendering and markup 
 ################################################################################
@@ -454,8 +499,15 @@ class JsonSerializableRegistry:
             An instance of the class populated with the data from json_dict_or_path.
         """
         if isinstance(json_dict_or_path, str):
-            with open(json_dict_or_path, 'r') as f:
-                json_dict = json.load(f)
+            with open(json_dict_or_path, 'rb') as f:
+                contents = f.read()
+
+            # orjson parses much faster than the standard json module, which matters for agents with large memories.
+            # However, it rejects the NaN and Infinity literals that json.dump writes for non-finite floats.
+            try:
+                json_dict = orjson.loads(contents)
+            except orjson.JSONDecodeError:
+                json_dict = json.loads(contents)
         else:
             json_dict = json_dict_or_path
         
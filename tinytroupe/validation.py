@@ -1,7 +1,10 @@
 import os
+import re
 import json
+import hashlib
 import chevron
 import logging
+from pydantic import BaseModel, ValidationError
 
 from tinytroupe import openai_utils
 from tinytroupe.agent import TinyPerson
@@ -14,8 +17,32 @@ default_max_content_display_length = config["OpenAI"].getint("MAX_CONTENT_DISPLA
 
 class TinyPersonValidator:
 
+    # Previous validation results, keyed by the person's specification and the expectations used.
+    _validation_cache = {}
+
+    @staticmethod
+    def _validation_cache_key(person, expectations, include_agent_spec) -> str:
+        """
+        Computes the key under which the validation of the given person against the given expectations is cached.
+        Only the stable part of the person's specification is used (i.e., not its current state, such as goals or context),
+        and the expectations are normalized, so that differences in whitespace or capitalization do not matter.
+        """
+        spec = {key: value for key, value in person._configuration.items() if not key.startswith("current")}
+        normalized_expectations = re.sub(r"\s+", " ", expectations).strip().lower() if expectations is not None else None
+
+        serialized = json.dumps({"spec": spec, "expectations": normalized_expectations, "include_agent_spec": include_agent_spec}, 
+                                sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def clear_cache():
+        """
+        Clears the cache of previous validation results.
+        """
+        TinyPersonValidator._validation_cache = {}
+
     @staticmethod
-    def validate_person(person, expectations=None, include_agent_spec=True, max_content_length=default_max_content_display_length) -> tuple[float, str]:
+    def validate_person(person, expectations=None, include_agent_spec=True, max_content_length=default_max_content_display_length, use_cache=False) -> tuple[float, str]:
         """
         Validate a TinyPerson instance using OpenAI's LLM.
 
@@ -28,18 +55,30 @@ class TinyPersonValidator:
             expectations (str, optional): The expectations to be used in the validation process. Defaults to None.
             include_agent_spec (bool, optional): Whether to include the agent specification in the prompt. Defaults to False.
             max_content_length (int, optional): The maximum length of the content to be displayed when rendering the conversation.
+            use_cache (bool, optional): Whether to reuse the result of a previous validation of the same person specification against 
+              the same expectations, instead of interviewing the person again. The person's memories and current state are not
+              taken into account, so this is only appropriate when they do not matter for the validation. The result is only
+              kept for later reuse if this is enabled. Defaults to False.
 
         Returns:
             float: The confidence score of the validation process (0.0 to 1.0), or None if the validation process fails.
             str: The justification for the validation score, or None if the validation process fails.
         """
+        logger = logging.getLogger("tinytroupe")
+
+        # Was this person already validated against these expectations?
+        if use_cache:
+            cache_key = TinyPersonValidator._validation_cache_key(person, expectations, include_agent_spec)
+            if cache_key in TinyPersonValidator._validation_cache:
+                logger.info(f"Reusing previous validation of the person: {person.name}")
+                return TinyPersonValidator._validation_cache[cache_key]
+
         # Initiating the current messages
         current_messages = []
         
         # Generating the prompt to check the person
         check_person_prompt_template_path = os.path.join(os.path.dirname(__file__), 'prompts/check_person.mustache')
-        with open(check_person_prompt_template_path, 'r') as f:
-            check_agent_prompt_template = f.read()
+        check_agent_prompt_template = utils.tokenized_template(check_person_prompt_template_path)
         
         system_prompt = chevron.render(check_agent_prompt_template, {"expectations": expectations})
 
@@ -57,9 +96,6 @@ class TinyPersonValidator:
         else:
             user_prompt += f"\n\nMini-biography of the person being interviewed: {person.minibio()}"
 
-
-        logger = logging.getLogger("tinytroupe")
-
         logger.info(f"Starting validation of the person: {person.name}")
 
         # Sending the initial messages to the LLM
@@ -86,14 +122,44 @@ class TinyPersonValidator:
             current_messages.append({"role": "user", "content": responses})
             message = openai_utils.client().send_message(current_messages)
 
+        result = None
         if message is not None:
-            json_content = utils.extract_json(message['content'])
             # read score and justification
-            score = float(json_content["score"])
-            justification = json_content["justification"]
-            logger.info(f"Validation score: {score:.2f}; Justification: {justification}")
+            result = TinyPersonValidator._parse_validation_result(message['content'])
+
+            if result is None:
+                # the final assessment is malformed, so we ask for it once more, this time constraining the output format
+                logger.warning(f"Could not read the validation result, asking for it again: {message['content']}")
+                current_messages.append({"role": message["role"], "content": message["content"]})
+                current_messages.append({"role": "user", "content": "Please give your final assessment again, as a JSON object with only the `score` and `justification` keys."})
+                message = openai_utils.client().send_message(current_messages, response_format=ValidationResult.model_json_schema())
+                if message is not None:
+                    result = TinyPersonValidator._parse_validation_result(message['content'])
+
+        if result is not None:
+            logger.info(f"Validation score: {result.score:.2f}; Justification: {result.justification}")
             
-            return score, justification
+            if use_cache:
+                TinyPersonValidator._validation_cache[cache_key] = (result.score, result.justification)
+            return result.score, result.justification
         
         else:
-            return None, None
\ No newline at end of file
+            return None, None
+
+    @staticmethod
+    def _parse_validation_result(content:str):
+        """
+        Reads the validation result from the given LLM output, returning None if it is not in the expected format.
+        """
+        try:
+            return ValidationResult.model_validate(utils.extract_json(content))
+        except ValidationError:
+            return None
+
+
+###########################################################################
+# Data structures to enforce output format during LLM API call.
+###########################################################################
+class ValidationResult(BaseModel):
+    score: float
+    justification: str
\ No newline at end of file